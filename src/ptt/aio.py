@@ -0,0 +1,447 @@
+import asyncio
+import os
+import threading
+import time
+
+from ptt import codec, conn, const, framing, outbox, peer
+
+class PeerProtocol(asyncio.BufferedProtocol):
+    def __init__(self, peer, loop):
+        self.peer = peer
+        self.decoder = framing.FrameDecoder(bufsize=peer.daemon.recv_bufsize)
+        self.direct = None
+        self.closed = loop.create_future()
+        self.can_write = asyncio.Event()
+        self.transport = None
+
+        self.can_write.set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        self.direct = self.peer.direct_buffer(self.decoder)
+
+        if self.direct is None:
+            return self.decoder.get_buffer()
+
+        return self.direct
+
+    def buffer_updated(self, nbytes):
+        direct = self.direct
+        self.direct = None
+        self.peer.last_recv = time.monotonic()
+
+        try:
+            if direct is None:
+                self.decoder.buffer_updated(nbytes)
+                self.peer.handle_data(self.decoder)
+            else:
+                direct.release()
+                self.peer.handle_direct(nbytes)
+        except Exception as e:
+            print(e)
+            self.transport.close()
+
+    def eof_received(self):
+        return False
+
+    def connection_lost(self, exc):
+        self.can_write.set()
+
+        if self.direct is not None:
+            self.direct.release()
+            self.direct = None
+
+        if not self.closed.done():
+            self.closed.set_result(exc)
+
+    def pause_writing(self):
+        self.can_write.clear()
+
+    def resume_writing(self):
+        self.can_write.set()
+
+class AsyncConn(conn.Conn):
+    def __init__(self, peer, loop):
+        super().__init__(peer)
+
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.protocol = None
+        self.transport = None
+        self.pending = []
+        self.pending_size = 0
+
+    def close(self):
+        if not self.transport:
+            return
+
+        self.pending = []
+        self.pending_size = 0
+
+        if threading.get_ident() == self.loop_thread:
+            self.transport.close()
+        else:
+            self.loop.call_soon_threadsafe(self.transport.close)
+
+        self.peer.setstate()
+        self.transport = None
+        self.tls_path = ''
+
+    def send(self, data, bounded=False):
+        if not self.transport or self.protocol.closed.done():
+            raise Exception(f'Peer {self.peer.alias}: connection closed')
+
+        if threading.get_ident() == self.loop_thread:
+            return self.enqueue(data, bounded)
+
+        future = asyncio.run_coroutine_threadsafe(self.write(data), self.loop)
+
+        return future.result()
+
+    def enqueue(self, data, bounded=False):
+        queued = self.transport.get_write_buffer_size() + self.pending_size
+
+        if bounded and queued + len(data) > const.SEND_QUEUE_MAX:
+            raise Exception(f'Peer {self.peer.alias} is busy')
+
+        if not self.pending:
+            self.loop.call_soon(self.flush)
+
+        self.pending.append(data)
+        self.pending_size += len(data)
+
+    def flush(self):
+        pending = self.pending
+        self.pending = []
+        self.pending_size = 0
+
+        if not self.transport or not pending:
+            return
+
+        if len(pending) == 1:
+            self.transport.write(pending[0])
+        else:
+            self.transport.writelines(pending)
+
+    async def drain(self):
+        self.flush()
+        await self.protocol.can_write.wait()
+
+    async def write(self, data):
+        await self.drain()
+
+        if not self.transport or self.protocol.closed.done():
+            raise Exception(f'Peer {self.peer.alias}: connection closed')
+
+        self.enqueue(data)
+
+    def recv(self, bufsize):
+        raise Exception('Cannot recv on an asyncio connection')
+
+    def recv_into(self, buffer, nbytes=0):
+        raise Exception('Cannot recv on an asyncio connection')
+
+    def sendfile(self, file, offset=0, count=None):
+        raise Exception('Cannot sendfile on an asyncio connection')
+
+    def abort(self):
+        if self.transport:
+            self.transport.abort()
+
+    async def wait_closed(self):
+        return await self.protocol.closed
+
+    async def connect(self, timeout=None):
+        server_side = self.peer.server_side()
+        addrs = [(addr, conn.address_family(addr[0])) for addr in self.peer.remote_addrs()]
+        started = self.loop.time()
+        established = self.established = asyncio.Queue()
+        punches = {}
+
+        if timeout is not None:
+            self.deadline = time.monotonic() + timeout
+
+        self.peer.setstate('connecting')
+
+        for i, (addr, family) in enumerate(addrs):
+            punches[addr] = self.loop.create_task(
+                self.punch(addr, family, established, i and const.CONNECT_FALLBACK_DELAY)
+            )
+
+        try:
+            while self.punching():
+                try:
+                    addr, family, sock = await asyncio.wait_for(established.get(), timeout=0.5)
+                except asyncio.TimeoutError:
+                    continue
+
+                try:
+                    handshake_started = self.loop.time()
+
+                    self.transport, self.protocol = await asyncio.wait_for(
+                        self.open_stream(sock, server_side),
+                        timeout=const.HANDSHAKE_TIMEOUT
+                    )
+
+                except (OSError, asyncio.TimeoutError):
+                    sock.close()
+
+                    if addr:
+                        punches[addr] = self.loop.create_task(
+                            self.punch(addr, family, established, conn.retry_delay(const.CONNECT_RETRY_MIN))
+                        )
+
+                    continue
+
+                self.handshake_time = self.loop.time() - handshake_started
+                self.connect_time = self.loop.time() - started
+                self.resumed = self.transport.get_extra_info('ssl_object').session_reused
+                self.transport.set_write_buffer_limits(high=const.FILE_CHUNK_SIZE)
+                self.tls_path = 'userspace'
+                self.peer.setstate('connected')
+
+                return
+
+        finally:
+            self.established = None
+
+            for punch in punches.values():
+                punch.cancel()
+
+            while not established.empty():
+                established.get_nowait()[2].close()
+
+        self.peer.setstate()
+
+        raise Exception('Failed to connect to peer')
+
+    def offer(self, family, sock):
+        self.loop.call_soon_threadsafe(self.put_offered, family, sock)
+
+        return True
+
+    def put_offered(self, family, sock):
+        if self.established is None:
+            sock.close()
+            return
+
+        sock.setblocking(False)
+        self.established.put_nowait((None, family, sock))
+
+    async def punch(self, addr, family, established, wait=0):
+        delay = const.CONNECT_RETRY_MIN
+
+        await asyncio.sleep(wait)
+
+        while self.punching():
+            deadline = self.loop.time() + conn.retry_delay(delay)
+            sock = None
+
+            try:
+                sock = self.bind_socket(family=family)
+                sock.setblocking(False)
+
+                await asyncio.wait_for(self.loop.sock_connect(sock, addr), timeout=delay)
+
+                established.put_nowait((addr, family, sock))
+                sock = None
+
+                return
+
+            except (OSError, asyncio.TimeoutError):
+                pass
+
+            finally:
+                if sock:
+                    sock.close()
+
+            await asyncio.sleep(max(0, deadline - self.loop.time()))
+            delay = min(delay * 2, const.CONNECT_RETRY_MAX)
+
+    async def open_stream(self, sock, server_side):
+        def protocol_factory():
+            return PeerProtocol(self.peer, self.loop)
+
+        if server_side:
+            return await self.loop.connect_accepted_socket(
+                protocol_factory,
+                sock=sock,
+                ssl=self.context
+            )
+
+        return await self.loop.create_connection(
+            protocol_factory,
+            sock=sock,
+            ssl=self.context,
+            server_hostname=self.peer.tls_name() or ''
+        )
+
+class AsyncPeer(peer.Peer):
+    def send(self, data, bounded=False):
+        if not self.conn:
+            raise Exception(f'Peer {self.alias} isn\'t connected')
+
+        return self.conn.send(data, bounded)
+
+    def send_bye(self):
+        peer_conn = self.conn
+
+        try:
+            peer_conn.send(self.encode_message('bye', {}))
+            peer_conn.flush()
+        except Exception:
+            return
+
+    async def run(self):
+        self.run_id += 1
+        run_id = self.run_id
+        timeout = None
+
+        while True:
+            connected = await self.run_session(timeout)
+
+            if not connected and timeout is None:
+                return
+
+            delay = self.reconnect_delay(connected)
+
+            if delay is None:
+                return
+
+            await asyncio.sleep(delay)
+
+            if not self.resume_connecting(run_id):
+                return
+
+            timeout = const.RECONNECT_ATTEMPT_TIMEOUT
+
+    async def run_session(self, timeout=None):
+        loop = asyncio.get_running_loop()
+        self.reset_hello()
+
+        try:
+            self.conn = AsyncConn(self, loop)
+            await self.conn.connect(timeout)
+        except Exception as e:
+            self.disconnect()
+            print(e)
+
+            return False
+
+        self.daemon.start_task(self.heartbeat_async(self.conn))
+
+        self.start_session()
+        self.send_hello()
+
+        self.daemon.recvd.put({
+            'type': 'connect',
+            'peer': self.alias,
+            'data': {}
+        })
+
+        exc = await self.conn.wait_closed()
+
+        if exc:
+            print(exc)
+
+        # Closing checkpoints every open transfer, which fsyncs.
+        await loop.run_in_executor(None, self.close_transfers)
+        self.disconnect()
+
+        self.daemon.recvd.put({
+            'type': 'disconnect',
+            'peer': self.alias,
+            'data': {}
+        })
+
+        return True
+
+    async def heartbeat_async(self, peer_conn):
+        interval = self.daemon.ping_timeout / const.PINGS_PER_TIMEOUT
+
+        try:
+            while True:
+                await asyncio.sleep(interval)
+
+                if not self.beat(peer_conn):
+                    return
+
+        except Exception as e:
+            print(e)
+
+    def read_chunk(self, stream):
+        header, offset, size, payload = stream.next_chunk()
+
+        if payload is None and size:
+            payload = os.pread(stream.file.fileno(), size, offset)
+
+        return header, payload
+
+    def checkpoint_transfer(self, incoming):
+        if incoming.syncing:
+            return
+
+        # Flush on the loop, where the writes happen, and fsync a duplicate descriptor in the
+        # executor so the transfer can still be closed meanwhile.
+        incoming.syncing = True
+        self.daemon.start_task(self.sync_transfer(incoming, incoming.offset, incoming.flush()))
+
+    async def sync_transfer(self, incoming, offset, fd):
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, os.fsync, fd)
+            incoming.durable = max(incoming.durable, offset)
+
+            if self.incoming.get(incoming.id) is incoming:
+                self.post_progress(incoming)
+
+        except Exception as e:
+            print(e)
+
+        finally:
+            os.close(fd)
+            incoming.syncing = False
+
+    def start_transfer(self, job):
+        self.daemon.start_task(self.run_transfer_async(job))
+
+    async def run_transfer_async(self, job):
+        try:
+            job.start()
+            await asyncio.get_running_loop().run_in_executor(None, self.prepare_delta, job)
+            await self.send_file_async(job)
+            job.finish('sent')
+        except Exception as e:
+            job.finish('failed', e)
+            print(e)
+        finally:
+            self.daemon.transfers.finish(job)
+
+    async def send_file_async(self, job):
+        loop = asyncio.get_running_loop()
+
+        with open(job.filepath, 'rb') as file:
+            self.sendmessage('file', self.file_message(job))
+            self.send_chunk_list(job)
+
+            segments = await loop.run_in_executor(None, self.delta_segments, job)
+            stream = outbox.FileStream(
+                job,
+                file,
+                self.encode_message,
+                segments,
+                codec.negotiate(self.peer_codecs)
+            )
+
+            while stream.segments:
+                header, payload = await loop.run_in_executor(None, self.read_chunk, stream)
+
+                await self.conn.drain()
+
+                self.send(header)
+
+                if payload is not None:
+                    self.send(payload)
+
+                stream.advance()
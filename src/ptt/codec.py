@@ -0,0 +1,48 @@
+import zlib
+
+from ptt import const
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+class ZlibCodec:
+    name = 'zlib'
+
+    def compress(self, data):
+        return zlib.compress(data, const.COMPRESS_LEVEL)
+
+    def decompressor(self):
+        return zlib.decompressobj()
+
+class Lz4Codec:
+    name = 'lz4'
+
+    def compress(self, data):
+        return lz4.frame.compress(data)
+
+    def decompressor(self):
+        return lz4.frame.LZ4FrameDecompressor()
+
+CODECS = {'zlib': ZlibCodec()}
+
+if lz4:
+    CODECS['lz4'] = Lz4Codec()
+
+PREFERENCE = ('lz4', 'zlib')
+
+def available():
+    return [name for name in PREFERENCE if name in CODECS]
+
+def negotiate(peer_codecs):
+    for name in available():
+        if name in peer_codecs:
+            return CODECS[name]
+
+    return None
+
+def decompressor(name):
+    codec = CODECS.get(name)
+
+    return codec.decompressor() if codec else None
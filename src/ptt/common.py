@@ -1,11 +1,12 @@
+import collections
+import datetime
 import ipaddress
-import json
 import os
-import socket
+import select
 import subprocess
 import sys
 
-from ptt import const
+from ptt import const, ipc
 
 def format_filesize(filesize):
     units = 'B'
@@ -22,11 +23,62 @@ def format_filesize(filesize):
 
     return f'{filesize}{units}'
 
+def format_duration(seconds):
+    seconds = round(seconds)
+
+    if seconds >= 3600:
+        return f'{seconds // 3600}h{seconds % 3600 // 60}m'
+
+    if seconds >= 60:
+        return f'{seconds // 60}m{seconds % 60}s'
+
+    return f'{seconds}s'
+
+def parse_time(val):
+    try:
+        return float(val)
+    except ValueError:
+        pass
+
+    try:
+        return datetime.datetime.fromisoformat(val).timestamp()
+    except ValueError:
+        raise Exception(f'Invalid time: {val}')
+
+def parse_limit(val):
+    try:
+        limit = int(val)
+
+        if limit <= 0:
+            raise Exception
+    except Exception:
+        raise Exception(f'Invalid limit: {val}')
+
+    return limit
+
+def parse_cursor(val):
+    try:
+        sort_time, rowid = val.split(':')
+        return [float(sort_time), int(rowid)]
+    except ValueError:
+        raise Exception(f'Invalid cursor: {val}')
+
 def ensure_daemon_running():
     if not kill_daemon(0):
         raise Exception('Daemon not running')
 
-def start_daemon(connect):
+def start_daemon(
+        connect,
+        engine='thread',
+        fast_recv=False,
+        recv_bufsize=const.DEFAULT_RECV_BUFSIZE,
+        durability=const.DEFAULT_DURABILITY,
+        ident4_endpoint=const.DEFAULT_IDENT4_ENDPOINT,
+        ident6_endpoint=const.DEFAULT_IDENT6_ENDPOINT,
+        activate=False,
+        shared_port=0,
+        ping_timeout=const.DEFAULT_PING_TIMEOUT
+):
     with open(const.LOG_PATH, 'w+') as logfile:
         with open(const.PID_PATH, 'w+') as pidfile:
             cmd_parts = ['python3', const.DAEMON_PATH]
@@ -34,14 +86,69 @@ def start_daemon(connect):
             if connect:
                 cmd_parts.append('connect')
 
-            proc = subprocess.Popen(
-                cmd_parts,
-                stdout=logfile,
-                stderr=logfile
-            )
+            if engine == 'asyncio':
+                cmd_parts.append('asyncio')
+
+            if fast_recv:
+                cmd_parts.append('fast_recv')
+
+            if recv_bufsize != const.DEFAULT_RECV_BUFSIZE:
+                cmd_parts.append(f'recv_bufsize={recv_bufsize}')
+
+            if durability != const.DEFAULT_DURABILITY:
+                cmd_parts.append(f'durability={durability}')
+
+            if ident4_endpoint != const.DEFAULT_IDENT4_ENDPOINT:
+                cmd_parts.append(f'ident4={ident4_endpoint}')
+
+            if ident6_endpoint != const.DEFAULT_IDENT6_ENDPOINT:
+                cmd_parts.append(f'ident6={ident6_endpoint}')
+
+            if shared_port:
+                cmd_parts.append(f'shared_port={shared_port}')
+
+            if ping_timeout != const.DEFAULT_PING_TIMEOUT:
+                cmd_parts.append(f'ping_timeout={ping_timeout}')
+
+            if activate:
+                server = ipc.listen(const.DEFAULT_IPC_SERVER_PATH)
+                pass_fd = server.fileno()
+                cmd_parts.append(f'server_fd={pass_fd}')
+            else:
+                read_fd, pass_fd = os.pipe()
+                cmd_parts.append(f'ready_fd={pass_fd}')
+
+            try:
+                proc = subprocess.Popen(
+                    cmd_parts,
+                    stdout=logfile,
+                    stderr=logfile,
+                    pass_fds=[pass_fd]
+                )
+            finally:
+                if activate:
+                    server.close()
+                else:
+                    os.close(pass_fd)
 
             pidfile.write(str(proc.pid))
 
+    if not activate:
+        wait_daemon_ready(read_fd)
+
+def wait_daemon_ready(read_fd, timeout=const.DAEMON_START_TIMEOUT):
+    try:
+        readable, _, _ = select.select([read_fd], [], [], timeout)
+
+        if not readable:
+            raise Exception(f'Daemon didn\'t start within {timeout}s, see {const.LOG_PATH}')
+
+        if not os.read(read_fd, 1):
+            raise Exception(f'Daemon failed to start, see {const.LOG_PATH}')
+
+    finally:
+        os.close(read_fd)
+
 def kill_daemon(code):
     try:
         with open(const.PID_PATH, 'r') as file:
@@ -61,13 +168,22 @@ def prompt(prompt, *, required=True):
 
     return val
 
-def prompt_remote_ip(alias, *, is_ipv6=False, required=False):
+def prompt_remote_ip(alias, *, is_ipv6=False, required=False, fallback=False, clearable=False):
     ipv = 6 if is_ipv6 else 4
-    remote_ip = prompt(f'Enter {alias}\'s IPv{ipv} address: ', required=required)
+
+    if clearable:
+        remote_ip = prompt(f'Enter {alias}\'s IPv{ipv} address to try too (optional, "none" to clear): ', required=False)
+    elif fallback:
+        remote_ip = prompt(f'Enter {alias}\'s IPv{ipv} address to try too (optional): ', required=False)
+    else:
+        remote_ip = prompt(f'Enter {alias}\'s IPv{ipv} address: ', required=required)
 
     if not remote_ip:
         return None
 
+    if clearable and remote_ip.lower() == 'none':
+        return ''
+
     try:
         if ipaddress.ip_address(remote_ip).version != ipv:
             raise Exception
@@ -76,6 +192,19 @@ def prompt_remote_ip(alias, *, is_ipv6=False, required=False):
 
     return remote_ip
 
+def prompt_remote_token(alias):
+    remote_token = prompt(f'Enter {alias}\'s token (optional): ', required=False)
+
+    if not remote_token:
+        return None
+
+    try:
+        bytes.fromhex(remote_token)
+    except ValueError:
+        raise Exception('Invalid token')
+
+    return remote_token.lower()
+
 def prompt_remote_port(alias, *, required=False):
     remote_port = prompt(f'Enter {alias}\'s port: ', required=required)
 
@@ -105,27 +234,25 @@ def remove_server_sock():
     except FileNotFoundError:
         pass
 
-def remove_client_sock():
-    try:
-        os.remove(const.DEFAULT_IPC_CLIENT_PATH)
-    except FileNotFoundError:
-        pass
-
 class Client:
     def __init__(self):
-        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
-        self.sock.bind(const.DEFAULT_IPC_CLIENT_PATH)
+        self.channel = None
+        self.next_id = 0
+        self.waiting = {}
 
     def close(self):
-        self.sock.close()
-        os.remove(const.DEFAULT_IPC_CLIENT_PATH)
+        if self.channel:
+            self.channel.close()
+            self.channel = None
 
     def exit(self, msg):
         self.close()
         sys.exit(msg)
 
     def ensure_peer_connected(self, alias):
-        if not list(self.show_peer(alias)).pop() == 'connected':
+        *_, state, _ = self.show_peer(alias)
+
+        if state != 'connected':
             raise Exception(f'Peer {alias} isn\'t connected')
 
     def ensure_peer_exists(self, alias):
@@ -134,18 +261,51 @@ class Client:
         if not res['data']['exists']:
             raise Exception(f'Peer {alias} doesn\'t exist')
 
-    def request(self, msg_type, msg_data):
-        payload = json.dumps({'type': msg_type, 'data': msg_data}).encode()
+    def submit(self, msg_type, msg_data):
+        if not self.channel:
+            self.channel = ipc.connect(const.DEFAULT_IPC_SERVER_PATH)
+
+        self.next_id += 1
+        self.waiting[self.next_id] = collections.deque()
+
+        self.channel.send({
+            'id': self.next_id,
+            'type': msg_type,
+            'data': msg_data
+        })
+
+        return self.next_id
 
-        self.sock.sendto(payload, const.DEFAULT_IPC_SERVER_PATH)
+    def responses(self, req_id):
+        pending = self.waiting[req_id]
+        more = True
 
-        dgram = self.sock.recv(4096)
-        res = json.loads(dgram.decode())
+        while more:
+            while not pending:
+                res = self.channel.next_message()
 
-        if 'error' in res and res['error']:
-            self.exit(res['error'])
+                try:
+                    self.waiting[res['id']].append(res)
+                except KeyError:
+                    raise Exception(f'Unexpected response to request {res["id"]}')
 
-        return res
+            res = pending.popleft()
+            more = res['more']
+
+            if not more:
+                del self.waiting[req_id]
+
+            yield res
+
+    def request_stream(self, msg_type, msg_data):
+        for res in self.responses(self.submit(msg_type, msg_data)):
+            if res['error']:
+                self.exit(res['error'])
+
+            yield res
+
+    def request(self, msg_type, msg_data):
+        return next(self.request_stream(msg_type, msg_data))
 
     def init_peer(self, alias, *, is_ipv6=False, new_port=False, should_exist=False):
         res = self.request('init_peer', {
@@ -159,15 +319,18 @@ class Client:
         public_ip4 = data['public_ip4']
         public_ip6 = data['public_ip6']
         local_port = data['local_port']
+        token = data['token']
 
-        return public_ip4, public_ip6, local_port
+        return public_ip4, public_ip6, local_port, token
 
-    def edit_peer(self, alias, new_alias, remote_ip, remote_port):
+    def edit_peer(self, alias, new_alias, remote_ip, remote_port, alt_ip=None, remote_token=None):
         return self.request('edit_peer', {
             'alias': alias,
             'new_alias': new_alias,
             'remote_ip': remote_ip,
-            'remote_port': remote_port
+            'remote_port': remote_port,
+            'alt_ip': alt_ip,
+            'remote_token': remote_token
         })
 
     def remove_peer(self, alias):
@@ -182,9 +345,17 @@ class Client:
         public_ip6 = data['public_ip6']
         remote_ip = data['remote_ip']
         remote_port = data['remote_port']
+        tls = data['tls']
+
+        if data.get('alt_ip'):
+            remote_ip = f'{remote_ip},{data["alt_ip"]}'
+
+        handshake = data.get('connect_time'), data.get('handshake_time'), data.get('resumed', False)
         state = data['state']
+        supervisor = data.get('supervisor', {})
+        health = supervisor.get('attempts', 0), supervisor.get('rtt'), supervisor.get('uptime')
 
-        return public_ip4, public_ip6, local_port, remote_ip, remote_port, state
+        return public_ip4, public_ip6, local_port, remote_ip, remote_port, tls, handshake, state, health
 
     def connect_peer(self, alias):
         return self.request('connect_peer', {'alias': alias})
@@ -198,21 +369,48 @@ class Client:
             'content': content
         })
 
-    def read_texts(self, alias):
-        res = self.request('read_texts', {'alias': alias})
+    def request_pages(self, msg_type, msg_data, key):
+        for res in self.request_stream(msg_type, msg_data):
+            yield from res['data'][key]
 
-        return res['data']['texts']
-
-    def share_file(self, alias, filepath):
-        return self.request('share_file', {
+    def read_texts(self, alias, since=None, before=None, limit=None, after=None):
+        return self.request_pages('read_texts', {
+            'alias': alias,
+            'since': since,
+            'before': before,
+            'limit': limit,
+            'after': after
+        }, 'texts')
+
+    def share_file(self, alias, filepath, delta=False, stripes=0):
+        res = self.request('share_file', {
             'alias': alias,
-            'filepath': filepath
+            'filepath': filepath,
+            'delta': delta,
+            'stripes': stripes
         })
 
-    def list_files(self, alias):
-        res = self.request('list_files', {'alias': alias})
+        return res['data']['job_id']
+
+    def transfer_status(self, alias):
+        res = self.request('transfer_status', {'alias': alias})
+
+        return res['data']['transfers']
 
-        return res['data']['files']
+    def cancel_transfer(self, alias, job_id):
+        return self.request('cancel_transfer', {
+            'alias': alias,
+            'job_id': job_id
+        })
+
+    def list_files(self, alias, since=None, before=None, limit=None, after=None):
+        return self.request_pages('list_files', {
+            'alias': alias,
+            'since': since,
+            'before': before,
+            'limit': limit,
+            'after': after
+        }, 'files')
 
     def stop_daemon(self):
         return self.request('stop', {})
@@ -1,12 +1,78 @@
+import ipaddress
 import os
+import queue
+import random
 import socket
 import ssl
+import threading
 import time
 
+from ptt import const
+
+SOL_TLS = getattr(socket, 'SOL_TLS', 282)
+TLS_TX = getattr(socket, 'TLS_TX', 1)
+TLS_RX = getattr(socket, 'TLS_RX', 2)
+
+contexts = {}
+contexts_lock = threading.Lock()
+
+def new_context(server_side):
+    proto = ssl.PROTOCOL_TLS_SERVER if server_side else ssl.PROTOCOL_TLS_CLIENT
+    context = ssl.SSLContext(proto)
+    context.options |= getattr(ssl, 'OP_ENABLE_KTLS', 0)
+
+    if server_side:
+        private_dir = os.path.normpath(
+            os.path.join(os.path.dirname(__file__), '..', '..', 'private')
+        )
+
+        context.load_cert_chain(
+            os.path.join(private_dir, 'cert.pem'),
+            os.path.join(private_dir, 'key.pem')
+        )
+
+    else:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+
+    return context
+
+def address_family(ip):
+    return socket.AF_INET6 if ipaddress.ip_address(ip).version == 6 else socket.AF_INET
+
+def retry_delay(delay):
+    return delay * random.uniform(1 - const.CONNECT_RETRY_JITTER, 1 + const.CONNECT_RETRY_JITTER)
+
+def tune_socket(sock):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 5)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 5)
+
+    if hasattr(socket, 'TCP_NOTSENT_LOWAT'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NOTSENT_LOWAT, const.SEND_LOWAT)
+
+    sock.settimeout(const.HANDSHAKE_TIMEOUT)
+
+def shared_context(server_side):
+    with contexts_lock:
+        if server_side not in contexts:
+            contexts[server_side] = new_context(server_side)
+
+        return contexts[server_side]
+
 class Conn:
     def __init__(self, peer):
         self.peer = peer
         self.sock = None
+        self.tls_path = ''
+        self.handshake_time = None
+        self.connect_time = None
+        self.resumed = False
+        self.established = None
+        self.established_lock = threading.Lock()
+        self.deadline = None
 
         self.create_context()
 
@@ -14,6 +80,11 @@ class Conn:
         if not self.sock:
             return
 
+        self.save_session()
+        self.close_socket()
+        self.peer.setstate()
+
+    def close_socket(self):
         try:
             self.sock.shutdown(socket.SHUT_WR)
         except Exception:
@@ -24,84 +95,268 @@ class Conn:
         except Exception:
             pass
 
-        self.peer.setstate()
         self.sock = None
+        self.tls_path = ''
+
+    def abort(self):
+        sock = self.sock
+
+        if not sock:
+            return
+
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
     def send(self, data):
         return self.sock.sendall(data)
 
+    def sendmsg(self, buffers, more=False):
+        if self.tls_path not in ('ktls', 'ktls-tx'):
+            return self.sock.sendall(b''.join(buffers) if len(buffers) > 1 else buffers[0])
+
+        flags = socket.MSG_MORE if more else 0
+        buffers = [memoryview(buffer) for buffer in buffers]
+
+        while buffers:
+            nsent = socket.socket.sendmsg(self.sock, buffers, [], flags)
+
+            while buffers and nsent >= len(buffers[0]):
+                nsent -= len(buffers.pop(0))
+
+            if nsent:
+                buffers[0] = buffers[0][nsent:]
+
     def recv(self, bufsize):
         return self.sock.recv(bufsize)
 
-    def sendfile(self, file):
-        return self.sock.sendfile(file)
+    def recv_into(self, buffer, nbytes=0):
+        return self.sock.recv_into(buffer, nbytes)
+
+    def sendfile(self, file, offset=0, count=None):
+        if self.tls_path in ('ktls', 'ktls-tx'):
+            return socket.socket.sendfile(self.sock, file, offset, count)
+
+        return self.sock.sendfile(file, offset, count)
+
+    def ktls_enabled(self, direction):
+        try:
+            self.sock.getsockopt(SOL_TLS, direction, 64)
+            return True
+        except OSError:
+            return False
+
+    def detect_tls_path(self):
+        tx = self.ktls_enabled(TLS_TX)
+        rx = self.ktls_enabled(TLS_RX)
+
+        if tx and rx:
+            return 'ktls'
+
+        if tx:
+            return 'ktls-tx'
+
+        if rx:
+            return 'ktls-rx'
+
+        return 'userspace'
+
+    def bind_socket(self, port=None, family=None):
+        if family is None:
+            family = socket.AF_INET6 if self.peer.is_ipv6 else socket.AF_INET
 
-    def bind_socket(self):
-        family = socket.AF_INET6 if self.peer.is_ipv6 else socket.AF_INET
         sock = socket.socket(family, socket.SOCK_STREAM)
 
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 5)
-        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
-        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 5)
-
-        sock.settimeout(10)
-
-        sock.bind(('', self.peer.local_port))
+        tune_socket(sock)
+        sock.bind(('', self.peer.local_port if port is None else port))
 
         return sock
 
     def create_context(self):
-        server_side = self.peer.server_side()
-        proto = ssl.PROTOCOL_TLS_SERVER if server_side else ssl.PROTOCOL_TLS_CLIENT
-        context = ssl.SSLContext(proto)
+        self.context = shared_context(self.peer.server_side())
 
-        if server_side:
-            private_dir = os.path.normpath(
-                os.path.join(os.path.dirname(__file__), '..', '..', 'private')
-            )
+    def wrap_socket(self, sock, server_side):
+        session = None if server_side else self.peer.tls_session
+        server_hostname = None if server_side else self.peer.tls_name()
+        started = time.monotonic()
 
-            context.load_cert_chain(
-                os.path.join(private_dir, 'cert.pem'),
-                os.path.join(private_dir, 'key.pem')
-            )
+        self.sock = self.context.wrap_socket(
+            sock=sock,
+            server_side=server_side,
+            server_hostname=server_hostname,
+            session=session
+        )
+        self.handshake_time = time.monotonic() - started
+        self.resumed = self.sock.session_reused
 
-        else:
-            context.check_hostname = False
-            context.verify_mode = ssl.CERT_NONE
+        self.sock.setblocking(True)
+        self.tls_path = self.detect_tls_path()
 
-        self.context = context
+    def save_session(self):
+        if self.sock.server_side:
+            return
 
-    def connect(self):
+        try:
+            session = self.sock.session
+        except Exception:
+            return
+
+        if session:
+            self.peer.tls_session = session
+
+    def connect(self, timeout=None):
         server_side = self.peer.server_side()
-        sock = None
+        addrs = [(addr, address_family(addr[0])) for addr in self.peer.remote_addrs()]
+        started = time.monotonic()
+        established = self.established = queue.Queue()
+
+        if timeout is not None:
+            self.deadline = started + timeout
 
         self.peer.setstate('connecting')
 
-        while self.peer.is_connecting():
+        for i, (addr, family) in enumerate(addrs):
+            self.start_punch(addr, family, established, i and const.CONNECT_FALLBACK_DELAY)
+
+        if self.accept_established(established, server_side):
+            self.connect_time = time.monotonic() - started
+            self.peer.setstate('connected')
+
+            return
+
+        self.peer.setstate()
+
+        raise Exception('Failed to connect to peer')
+
+    def punching(self):
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            return False
+
+        return self.peer.is_connecting()
+
+    def accept_established(self, established, server_side):
+        try:
+            while self.punching():
+                try:
+                    addr, family, sock = established.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+
+                try:
+                    self.wrap_socket(sock, server_side)
+                except OSError:
+                    sock.close()
+
+                    if addr:
+                        self.start_punch(addr, family, established, retry_delay(const.CONNECT_RETRY_MIN))
+
+                    continue
+
+                return True
+
+        finally:
+            with self.established_lock:
+                self.established = None
+
+            while not established.empty():
+                established.get()[2].close()
+
+        return False
+
+    def offer(self, family, sock):
+        with self.established_lock:
+            if self.established is None:
+                return False
+
+            self.established.put((None, family, sock))
+
+        return True
+
+    def start_punch(self, addr, family, established, wait=0):
+        threading.Thread(target=self.punch, args=(addr, family, established, wait), daemon=True).start()
+
+    def punch(self, addr, family, established, wait=0):
+        delay = const.CONNECT_RETRY_MIN
+        sock = None
+
+        time.sleep(wait)
+
+        while self.punching():
+            deadline = time.monotonic() + retry_delay(delay)
+            sock = None
+
             try:
-                sock = self.bind_socket()
-                sock.connect(self.peer.remote_addr())
-                self.sock = self.context.wrap_socket(sock=sock, server_side=server_side)
+                sock = self.bind_socket(family=family)
+                sock.settimeout(delay)
+                sock.connect(addr)
+                sock.settimeout(const.HANDSHAKE_TIMEOUT)
 
-                self.sock.setblocking(True)
-                self.peer.setstate('connected')
+                # Once connect gives up on this queue, nobody will take the socket.
+                with self.established_lock:
+                    if self.punching() and self.established is established:
+                        established.put((addr, family, sock))
 
-                return
+                        return
 
-            except ConnectionRefusedError:
-                time.sleep(1)
+                break
 
-            except (socket.timeout, TimeoutError):
+            except OSError:
                 pass
 
             if sock:
                 sock.close()
                 sock = None
 
-        self.peer.setstate()
+            time.sleep(max(0, deadline - time.monotonic()))
+            delay = min(delay * 2, const.CONNECT_RETRY_MAX)
 
-        raise Exception('Failed to connect to peer')
+        if sock:
+            sock.close()
+
+class StripeConn(Conn):
+    def __init__(self, peer, index):
+        super().__init__(peer)
+
+        self.index = index
+        self.port = peer.local_port + index
+        self.deadline = 0
+
+    def close(self):
+        if not self.sock:
+            return
+
+        try:
+            self.sock.shutdown(socket.SHUT_WR)
+            self.sock.settimeout(const.STRIPE_CONNECT_TIMEOUT)
+
+            while self.sock.recv(const.DEFAULT_RECV_BUFSIZE):
+                pass
+
+        except Exception:
+            pass
+
+        self.close_socket()
+
+    def bind_socket(self, port=None, family=None):
+        return super().bind_socket(self.port if port is None else port, family)
+
+    def punching(self):
+        return self.peer.is_connected() and time.monotonic() < self.deadline
+
+    def connect(self):
+        if self.port in self.peer.daemon.peers.local_ports() or self.port == self.peer.daemon.shared_port:
+            raise Exception(f'Peer {self.peer.alias}: port {self.port} for stripe {self.index} belongs to another peer')
+
+        addrs = [((ip, port + self.index), address_family(ip)) for ip, port in self.peer.remote_addrs()]
+        established = self.established = queue.Queue()
+        self.deadline = time.monotonic() + const.STRIPE_CONNECT_TIMEOUT
+
+        for i, (addr, family) in enumerate(addrs):
+            self.start_punch(addr, family, established, i and const.CONNECT_FALLBACK_DELAY)
+
+        if not self.accept_established(established, self.peer.server_side()):
+            raise Exception(f'Peer {self.peer.alias}: failed to open stripe {self.index}')
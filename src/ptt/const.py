@@ -16,5 +16,71 @@ DEFAULT_DB_PATH = os.path.join(PRIVATE_PATH, 'ptt.db')
 DEFAULT_FILES_PATH = os.path.join(PRIVATE_PATH, 'files')
 DEFAULT_IDENT4_ENDPOINT = 'https://v4.ident.me'
 DEFAULT_IDENT6_ENDPOINT = 'https://v6.ident.me'
-DEFAULT_IPC_CLIENT_PATH = '/tmp/ptt_client'
+IDENT_TIMEOUT = 5
 DEFAULT_IPC_SERVER_PATH = '/tmp/ptt_server'
+
+DAEMON_START_TIMEOUT = 30
+SD_LISTEN_FDS_START = 3
+
+IPC_BUFSIZE = 65536
+IPC_MAX_PENDING = 16 * 1024 * 1024
+MAX_CONCURRENT_TASKS = 64
+IPC_PAGE_SIZE = 32768
+HISTORY_PAGE_ROWS = 256
+
+DEFAULT_RECV_BUFSIZE = 65536
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+FILE_CHUNK_SIZE = 64 * 1024
+TRANSFER_CHECKPOINT_SIZE = 8 * 1024 * 1024
+TRANSFER_RETENTION = 10 * 60
+MAX_STREAMS_PER_PEER = 4
+SEND_LOWAT = 128 * 1024
+SEND_COALESCE_SIZE = 16 * 1024
+SEND_QUEUE_MAX = 4 * 1024 * 1024
+
+MAX_STRIPES = 8
+STRIPE_MIN_SIZE = 64 * 1024 * 1024
+STRIPE_CONNECT_TIMEOUT = 10
+
+CONNECT_RETRY_MIN = 0.25
+CONNECT_RETRY_MAX = 2
+CONNECT_RETRY_JITTER = 0.2
+CONNECT_FALLBACK_DELAY = 0.25
+HANDSHAKE_TIMEOUT = 10
+
+DEFAULT_PING_TIMEOUT = 15
+PINGS_PER_TIMEOUT = 3
+RECONNECT_MIN = 1
+RECONNECT_MAX = 60
+RECONNECT_RESET_TIME = 60
+RECONNECT_ATTEMPT_TIMEOUT = 30
+BYE_TIMEOUT = 1
+
+MAX_AUTO_CONNECTS = 16
+AUTO_CONNECT_TIMEOUT = 30
+AUTO_CONNECT_POLL_INTERVAL = 0.5
+
+DEMUX_BACKLOG = 64
+DEMUX_TIMEOUT = 1
+DEMUX_PEEK_SIZE = 16 * 1024 + 5
+DEMUX_POLL_INTERVAL = 0.5
+PEER_TOKEN_SIZE = 8
+
+DELTA_MIN_CHUNK_SIZE = 32 * 1024
+DELTA_AVG_CHUNK_SIZE = 128 * 1024
+DELTA_MAX_CHUNK_SIZE = 512 * 1024
+DELTA_READ_SIZE = 1024 * 1024
+DELTA_SCAN_SIZE = 32 * 1024
+DELTA_HAVE_TIMEOUT = 600
+DELTA_PAGE_SIZE = 64 * 1024
+
+COMPRESS_LEVEL = 1
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_MIN_RATIO = 0.9
+COMPRESS_PROBE_INTERVAL = 16
+
+DEFAULT_DURABILITY = 'normal'
+DB_CACHED_STATEMENTS = 256
+DB_BATCH_SIZE = 256
+DB_BATCH_INTERVAL = 0.05
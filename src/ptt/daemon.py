@@ -1,64 +1,102 @@
 import asyncio
+import ipaddress
 import json
-import queue
+import os
 import select
-import socket
-import sqlite3
 import sys
 import threading
-import urllib
+import time
 import urllib.request as request
 import desktop_notify
 
-from ptt import common, const
+from ptt import common, const, demux, dispatch, ipc, registry, storage, transfer
+from aio import AsyncPeer
 from peer import Peer
 from pollqueue import PollQueue
 
+def resolve_public_ip(endpoint):
+    return request.urlopen(endpoint, timeout=const.IDENT_TIMEOUT).read().decode('utf8').strip()
+
 class Daemon:
     def __init__(
             self,
             *,
             connect_peers=False,
+            engine='thread',
+            fast_recv=False,
+            recv_bufsize=const.DEFAULT_RECV_BUFSIZE,
+            durability=const.DEFAULT_DURABILITY,
             db_path=const.DEFAULT_DB_PATH,
             files_path=const.DEFAULT_FILES_PATH,
             ident4_endpoint=const.DEFAULT_IDENT4_ENDPOINT,
             ident6_endpoint=const.DEFAULT_IDENT6_ENDPOINT,
-            ipc_client_path=const.DEFAULT_IPC_CLIENT_PATH,
-            ipc_server_path=const.DEFAULT_IPC_SERVER_PATH
+            ipc_server_path=const.DEFAULT_IPC_SERVER_PATH,
+            server_fileno=None,
+            shared_port=0,
+            ping_timeout=const.DEFAULT_PING_TIMEOUT,
+            resolver=resolve_public_ip
         ):
 
-        self.db_changed = False
-        self.db_conn = sqlite3.connect(db_path)
-        self.db_cursor = self.db_conn.cursor()
+        self.db = storage.Storage(db_path, durability=durability)
         self.db_path = db_path
 
+        self.engine = engine
+        self.fast_recv = fast_recv
         self.files_path = files_path
+        self.recv_bufsize = recv_bufsize
+        self.shared_port = shared_port
+        self.ping_timeout = ping_timeout
 
-        self.ipc_client_path = ipc_client_path
         self.ipc_server_path = ipc_server_path
 
-        self.public_ip4 = request.urlopen(ident4_endpoint).read().decode('utf8')
-
-        try:
-            self.public_ip6 = request.urlopen(ident6_endpoint).read().decode('utf8')
-        except urllib.error.URLError:
-            self.public_ip6 = ''
+        self.ident_endpoints = {4: ident4_endpoint, 6: ident6_endpoint}
+        self.resolver = resolver
+        self.public_ip4 = ''
+        self.public_ip6 = ''
 
-        self.peers = {}
+        self.peers = registry.PeerRegistry(self.create_peer)
+        self.connector = registry.ConnectScheduler(self.peers, self.start_peer)
         self.recvd = PollQueue()
+        self.transfers = transfer.TransferScheduler()
 
-        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
-        self.server.bind(ipc_server_path)
+        self.server = ipc.listen(ipc_server_path, server_fileno)
+        self.clients = []
+        self.streams = []
 
         self.notifier = desktop_notify.aio.Server('ptt')
         self.tasks = []
+        self.dispatcher = dispatch.Dispatcher(on_done=self.wake)
+        self.ready = None
 
         self.init_db()
+        self.load_public_ips()
+        self.refresh_public_ips()
         self.init_peers(connect_peers)
 
+        self.demux = demux.SharedPort(self, shared_port) if shared_port else None
+
+        if self.demux:
+            self.demux.start()
+
     def init_db(self):
         self.db_write('''CREATE TABLE IF NOT EXISTS peers
-            (alias text, local_port int, remote_ip text, remote_port int)''')
+            (alias text, local_port int, remote_ip text, remote_port int, alt_ip text, last_seen numeric,
+            token text DEFAULT '', remote_token text DEFAULT '')''')
+
+        columns = [row[1] for row in self.db_read('PRAGMA table_info(peers)').fetchall()]
+
+        if 'alt_ip' not in columns:
+            self.db_write('ALTER TABLE peers ADD COLUMN alt_ip text DEFAULT \'\'')
+
+        if 'last_seen' not in columns:
+            self.db_write('ALTER TABLE peers ADD COLUMN last_seen numeric')
+
+        if 'token' not in columns:
+            self.db_write('ALTER TABLE peers ADD COLUMN token text DEFAULT \'\'')
+            self.db_write(f'UPDATE peers SET token = lower(hex(randomblob({const.PEER_TOKEN_SIZE})))')
+
+        if 'remote_token' not in columns:
+            self.db_write('ALTER TABLE peers ADD COLUMN remote_token text DEFAULT \'\'')
 
         self.db_write('''CREATE UNIQUE INDEX IF NOT EXISTS index_local_port
             ON peers(local_port)''')
@@ -69,75 +107,215 @@ class Daemon:
         self.db_write('''CREATE TABLE IF NOT EXISTS texts
             (peer text, content text, sent_at numeric, from_peer bool)''')
 
+        self.db_write('''CREATE INDEX IF NOT EXISTS index_text_peer
+            ON texts(peer, sent_at)''')
+
         self.db_write('''CREATE TABLE IF NOT EXISTS files
             (peer text, filename text, filepath text, filesize int, shared_at numeric, from_peer bool)''')
 
+        self.db_write('''CREATE INDEX IF NOT EXISTS index_file_peer
+            ON files(peer, shared_at)''')
+
+        self.db_write('''CREATE TABLE IF NOT EXISTS transfers
+            (id text, peer text, filename text, filepath text, filesize int, shared_at numeric, offset int, from_peer bool)''')
+
+        self.db_write('''CREATE UNIQUE INDEX IF NOT EXISTS index_transfer_id
+            ON transfers(id, from_peer)''')
+
+        self.db_write('''CREATE TABLE IF NOT EXISTS chunk_index
+            (path text, size int, mtime int, chunks text)''')
+
+        self.db_write('''CREATE UNIQUE INDEX IF NOT EXISTS index_chunk_path
+            ON chunk_index(path)''')
+
+        self.db_write('''CREATE TABLE IF NOT EXISTS public_ips
+            (version int, ip text, updated_at numeric)''')
+
+        self.db_write('''CREATE UNIQUE INDEX IF NOT EXISTS index_public_ip_version
+            ON public_ips(version)''')
+
         self.db_commit()
 
+    def load_public_ips(self):
+        for version, ip in self.db_read('SELECT version, ip FROM public_ips').fetchall():
+            self.set_public_ip(version, ip)
+
+    def set_public_ip(self, version, ip):
+        if version == 4:
+            self.public_ip4 = ip
+        else:
+            self.public_ip6 = ip
+
+    def refresh_public_ips(self):
+        for version in self.ident_endpoints:
+            threading.Thread(target=self.refresh_public_ip, args=(version,), daemon=True).start()
+
+    def refresh_public_ip(self, version):
+        try:
+            ip = self.resolver(self.ident_endpoints[version])
+
+            if ipaddress.ip_address(ip).version != version:
+                raise Exception(f'{ip} isn\'t an IPv{version} address')
+
+        except Exception as e:
+            print(f'Failed to look up public IPv{version} address: {e}')
+            return
+
+        self.recvd.put({
+            'type': 'public_ip',
+            'peer': None,
+            'data': {'version': version, 'ip': ip}
+        })
+
+    def handle_public_ip(self, data):
+        self.set_public_ip(data['version'], data['ip'])
+
+        self.db_write(
+            'INSERT OR REPLACE INTO public_ips VALUES (?, ?, ?)',
+            (data['version'], data['ip'], time.time())
+        )
+
     def init_peers(self, connect_peers):
-        sql = 'SELECT * FROM peers'
+        sql = 'SELECT alias, local_port, remote_ip, remote_port, alt_ip, token, remote_token, last_seen FROM peers'
 
-        for alias, local_port, remote_ip, remote_port in self.db_cursor.execute(sql):
-            peer = Peer(self, alias, local_port, remote_ip, remote_port)
-            peer.init()
-            self.peers[alias] = peer
+        self.peers.load(self.db_read(sql).fetchall())
 
-            if connect_peers:
-                print('connecting ' + alias)
-                threading.Thread(target=peer.run, daemon=True).start()
+        if connect_peers:
+            self.connector.schedule(self.peers.by_activity())
 
-    def db_read(self, sql):
-        return self.db_cursor.execute(sql)
+    def create_peer(self, *args):
+        if self.engine == 'asyncio':
+            return AsyncPeer(self, *args)
 
-    def db_write(self, sql):
-        self.db_cursor.execute(sql)
-        self.db_changed = True
+        return Peer(self, *args)
 
-    def db_commit(self):
-        if self.db_changed:
-            self.db_conn.commit()
-            self.db_changed = False
+    def start_peer(self, peer):
+        if not peer.local_port:
+            raise Exception(f'Peer {peer.alias} uses a shared port, start the daemon with --shared-port')
+
+        peer.setstate('connecting')
+
+        if self.engine == 'asyncio':
+            self.start_task(peer.run())
+        else:
+            threading.Thread(target=peer.run, daemon=True).start()
+
+    async def hang_up(self, peer):
+        if self.engine == 'asyncio':
+            return peer.hang_up()
+
+        # Waits for the outbox to write the bye frame.
+        return await asyncio.get_running_loop().run_in_executor(None, peer.hang_up)
+
+    def start_task(self, coro):
+        task = asyncio.ensure_future(coro)
+        self.tasks.append(task)
+        task.add_done_callback(self.tasks.remove)
+
+        return task
+
+    def db_read(self, sql, params=()):
+        return self.db.read(sql, params)
+
+    def db_write(self, sql, params=()):
+        self.db.write(sql, params)
+
+    def db_commit(self, force=True):
+        self.db.flush(force)
 
     async def run(self):
         done = False
-        rlist = [self.server, self.recvd]
 
         while not done:
             try:
-                can_read, _, _ = select.select(rlist, [], [])
+                rlist = [self.server, self.recvd]
+                rlist += [client for client in self.clients if len(client.outbuf) < const.IPC_MAX_PENDING]
+                wlist = [client for client in self.clients if client.outbuf]
+                self.connector.poll()
+
+                ready = any(not stream.channel.outbuf for stream in self.streams)
+                timeouts = [t for t in (self.db.timeout(), self.connector.timeout()) if t is not None]
+                timeout = 0 if ready else min(timeouts, default=None)
+                can_read = await self.wait_readable(rlist, timeout, wlist)
 
                 if self.server in can_read:
-                    req = self.server.recv(4096)
-                    done = self.handle_request(req)
+                    self.clients.append(ipc.accept(self.server))
+
+                for client in self.clients[:]:
+                    if client in can_read:
+                        done = self.handle_client(client) or done
+
+                self.flush_clients()
+                self.send_streams()
 
                 if self.recvd in can_read:
-                    msg = self.recvd.get(block=False)
-                    await self.handle_message(msg)
+                    for msg in self.recvd.drain():
+                        self.dispatcher.submit(msg['peer'], self.handle_message(msg))
 
-                self.db_commit()
+                self.db_commit(force=False)
 
             except Exception as e:
                 print(e)
 
-        for peer in self.peers.values():
+        await self.dispatcher.join()
+
+        if self.demux:
+            self.demux.close()
+
+        for peer in self.peers.loaded():
             peer.close()
 
+        for client in self.clients:
+            client.flush()
+            client.close()
+
         self.server.close()
 
-        done = self.recvd.empty()
+        msgs = self.recvd.drain()
 
-        while not done:
-            try:
-                msg = self.recvd.get(False)
-                await self.handle_message(msg)
-                self.db_commit()
+        while msgs:
+            for msg in msgs:
+                try:
+                    await self.handle_message(msg)
+                except Exception as e:
+                    print(e)
 
-            except queue.Empty:
-                done = True
+            msgs = self.recvd.drain()
 
-        self.db_conn.close()
+        self.db.close()
         self.recvd.close()
 
+    def wake(self, *_):
+        if self.ready and not self.ready.done():
+            self.ready.set_result(None)
+
+    async def wait_readable(self, rlist, timeout=None, wlist=()):
+        loop = asyncio.get_running_loop()
+        self.ready = loop.create_future()
+
+        for obj in rlist:
+            loop.add_reader(obj, self.wake)
+
+        for obj in wlist:
+            loop.add_writer(obj, self.wake)
+
+        try:
+            await asyncio.wait_for(self.ready, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.ready = None
+
+            for obj in rlist:
+                loop.remove_reader(obj)
+
+            for obj in wlist:
+                loop.remove_writer(obj)
+
+        can_read, _, _ = select.select(rlist, [], [], 0)
+
+        return can_read
+
     async def handle_message(self, msg):
         alias = msg['peer']
         msg_type = msg['type']
@@ -155,20 +333,55 @@ class Daemon:
         elif msg_type == 'file':
             await self.handle_file(alias, msg_data)
 
+        elif msg_type == 'transfer':
+            self.handle_transfer(alias, msg_data)
+
+        elif msg_type == 'delta':
+            self.handle_delta(alias, msg_data)
+
+        elif msg_type == 'progress':
+            self.handle_progress(alias, msg_data)
+
+        elif msg_type == 'resume':
+            self.get_peer(alias).resume_transfers(msg_data['transfers'])
+
+        elif msg_type == 'done':
+            self.get_peer(alias).complete_transfer(msg_data['id'])
+
+        elif msg_type == 'cancel':
+            await self.handle_cancel(alias, msg_data)
+
+        elif msg_type == 'index':
+            self.handle_index(msg_data)
+
+        elif msg_type == 'public_ip':
+            self.handle_public_ip(msg_data)
+
         else:
             raise Exception(f'Unexpected message type "{msg_type}" from {alias}')
 
     async def handle_connect(self, alias):
+        self.get_peer(alias).send_resume()
+        self.touch_peer(alias)
+
         await self.notify(f'Peer {alias} connected')
 
     async def handle_disconnect(self, alias):
+        self.touch_peer(alias)
+
         await self.notify(f'Peer {alias} disconnected')
 
+    def touch_peer(self, alias):
+        seen_at = time.time()
+
+        self.db_write('UPDATE peers SET last_seen = ? WHERE alias = ?', (seen_at, alias))
+        self.peers.touch(alias, seen_at)
+
     async def handle_text(self, alias, data):
         content = data['content']
         sent_at = data['sent_at']
 
-        self.db_write(f'INSERT INTO texts VALUES ("{alias}", "{content}", {sent_at}, {True})')
+        self.db_write('INSERT INTO texts VALUES (?, ?, ?, ?)', (alias, content, sent_at, True))
 
         await self.notify(f'Peer {alias} sent text: {content}')
 
@@ -178,25 +391,155 @@ class Daemon:
         filesize = data['filesize']
         shared_at = data['shared_at']
 
-        self.db_write(f'''INSERT INTO files VALUES
-            ("{alias}", "{filename}", "{filepath}", {filesize}, {shared_at}, {True})''')
+        self.db_write(
+            'INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)',
+            (alias, filename, filepath, filesize, shared_at, True)
+        )
+
+        self.db_write(
+            'UPDATE transfers SET offset = ? WHERE id = ? AND from_peer = ?',
+            (filesize, data['id'], True)
+        )
+
+        self.db_commit()
+
+        peer = self.get_peer(alias)
+
+        if peer.is_connected():
+            peer.sendmessage('done', {'id': data['id']})
 
         fmt_size = common.format_filesize(filesize)
 
         await self.notify(f'Peer {alias} sent file: {filename} ({fmt_size})')
 
+    def handle_transfer(self, alias, data):
+        self.db_write('INSERT OR REPLACE INTO transfers VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (
+            data['id'],
+            alias,
+            data['filename'],
+            data['filepath'],
+            data['filesize'],
+            data['shared_at'],
+            data['offset'],
+            True
+        ))
+
+    def handle_delta(self, alias, data):
+        peer = self.get_peer(alias)
+        sources = self.delta_sources(alias)
+
+        threading.Thread(
+            target=peer.answer_delta,
+            args=(data['id'], data['chunks'], sources),
+            daemon=True
+        ).start()
+
+    def handle_index(self, data):
+        self.db_write('INSERT OR REPLACE INTO chunk_index VALUES (?, ?, ?, ?)', (
+            data['path'],
+            data['size'],
+            data['mtime'],
+            json.dumps(data['chunks'])
+        ))
+
+    def cached_chunks(self, path, stat=None):
+        try:
+            stat = stat or os.stat(path)
+        except OSError:
+            return None
+
+        sql = 'SELECT chunks FROM chunk_index WHERE path = ? AND size = ? AND mtime = ?'
+        row = self.db_read(sql, (path, stat.st_size, stat.st_mtime_ns)).fetchone()
+
+        return json.loads(row[0]) if row else None
+
+    def delta_sources(self, alias):
+        sql = 'SELECT DISTINCT filepath FROM files WHERE peer = ? AND from_peer = ?'
+        rows = self.db_read(sql, (alias, True)).fetchall()
+
+        return [(path, self.cached_chunks(path)) for path, in rows if os.path.isfile(path)]
+
+    def handle_progress(self, alias, data):
+        self.db_write(
+            'UPDATE transfers SET offset = ? WHERE id = ? AND peer = ? AND from_peer = ?',
+            (data['offset'], data['id'], alias, True)
+        )
+
+    async def handle_cancel(self, alias, data):
+        sql = 'SELECT filename FROM transfers WHERE id = ? AND peer = ? AND from_peer = ?'
+        row = self.db_read(sql, (data['id'], alias, True)).fetchone()
+
+        if not row:
+            return
+
+        self.db_write(
+            'DELETE FROM transfers WHERE id = ? AND from_peer = ?',
+            (data['id'], True)
+        )
+
+        await self.notify(f'Peer {alias} cancelled file: {row[0]}')
+
     async def notify(self, body):
         await self.notifier.Notify('ptt', body).show()
 
-    def handle_request(self, req):
-        if not req:
-            return True
+    def handle_client(self, client):
+        try:
+            reqs = client.recv()
+        except OSError:
+            reqs = None
+
+        if reqs is None:
+            self.close_client(client)
+            return False
+
+        done = False
+
+        for req in reqs:
+            done = done or req['type'] == 'stop'
+            self.dispatcher.submit(req['data'].get('alias'), self.run_request(client, req))
 
-        req = json.loads(req.decode())
+        return done
+
+    async def run_request(self, client, req):
+        try:
+            await self.handle_request(client, req)
+        except OSError:
+            if client in self.clients:
+                self.close_client(client)
+
+    def close_client(self, client):
+        client.close()
+        self.clients.remove(client)
+        self.streams = [stream for stream in self.streams if stream.channel is not client]
+
+    def flush_clients(self):
+        for client in self.clients[:]:
+            try:
+                client.flush()
+            except OSError:
+                self.close_client(client)
+
+    def send_streams(self):
+        for stream in self.streams[:]:
+            if stream.channel.outbuf:
+                continue
+
+            try:
+                stream.send_page()
+            except OSError:
+                self.close_client(stream.channel)
+                continue
+
+            if stream.done:
+                self.streams.remove(stream)
+
+    async def handle_request(self, client, req):
+        req_id = req['id']
         req_type = req['type']
         req_data = req['data']
 
         data = {}
+        stream = None
 
         try:
             if req_type == 'peer_exists':
@@ -228,10 +571,11 @@ class Daemon:
                 if peer:
                     peer.disconnect()
                 else:
-                    peer = Peer(self, alias)
-                    self.peers[alias] = peer
+                    peer = self.create_peer(alias)
+                    self.peers.add(alias, peer)
 
                 data['local_port'] = peer.init(is_ipv6, new_port)
+                data['token'] = peer.token
                 data['public_ip4'] = self.public_ip4
                 data['public_ip6'] = self.public_ip6
 
@@ -240,6 +584,8 @@ class Daemon:
                 new_alias = req_data['new_alias']
                 remote_ip = req_data['remote_ip']
                 remote_port = req_data['remote_port']
+                alt_ip = req_data.get('alt_ip')
+                remote_token = req_data.get('remote_token')
 
                 peer = self.get_peer(alias)
 
@@ -256,18 +602,19 @@ class Daemon:
                 peer.edit(
                     alias=new_alias,
                     remote_ip=remote_ip,
-                    remote_port=remote_port
+                    remote_port=remote_port,
+                    alt_ip=alt_ip,
+                    remote_token=remote_token
                 )
 
                 if new_alias:
-                    self.peers[new_alias] = peer
-                    del self.peers[alias]
+                    self.peers.rename(alias, new_alias)
 
             elif req_type == 'remove_peer':
                 alias = req_data['alias']
                 peer = self.get_peer(alias)
                 peer.delete()
-                del self.peers[alias]
+                self.peers.remove(alias)
 
             elif req_type == 'show_peer':
                 alias = req_data['alias']
@@ -277,7 +624,12 @@ class Daemon:
                 data['public_ip6'] = self.public_ip6
                 data['remote_ip'] = peer.remote_ip
                 data['remote_port'] = peer.remote_port
+                data['alt_ip'] = peer.alt_ip
+                data['tls'] = peer.tls_path()
+                data['connect_time'] = peer.connect_time()
+                data['handshake_time'], data['resumed'] = peer.tls_handshake()
                 data['state'] = peer.getstate()
+                data['supervisor'] = peer.supervisor_state()
 
             elif req_type == 'connect_peer':
                 alias = req_data['alias']
@@ -289,13 +641,13 @@ class Daemon:
                 if peer.is_connecting():
                     raise Exception(f'Peer {alias} is already connecting')
 
-                threading.Thread(target=peer.run, daemon=True).start()
+                self.start_peer(peer)
 
             elif req_type == 'disconnect_peer':
                 alias = req_data['alias']
                 peer = self.get_peer(alias)
 
-                if not peer.disconnect():
+                if not await self.hang_up(peer):
                     raise Exception(f'Peer {alias} isn\'t connected')
 
             elif req_type == 'send_text':
@@ -308,54 +660,100 @@ class Daemon:
             elif req_type == 'read_texts':
                 alias = req_data['alias']
                 peer = self.get_peer(alias)
-                data['texts'] = peer.read_texts()
+
+                stream = ipc.Stream(client, req_id, 'texts', peer.read_texts(
+                    req_data.get('since'),
+                    req_data.get('before'),
+                    req_data.get('limit'),
+                    req_data.get('after')
+                ))
 
             elif req_type == 'share_file':
                 alias = req_data['alias']
                 filepath = req_data['filepath']
                 peer = self.get_peer(alias)
+                stat = await asyncio.get_running_loop().run_in_executor(None, os.stat, filepath)
 
-                peer.share_file(filepath)
+                job = peer.share_file(filepath, stat, req_data.get('delta', False), req_data.get('stripes', 0))
+                data['job_id'] = job.id
+
+            elif req_type == 'transfer_status':
+                alias = req_data['alias']
+                peer = self.get_peer(alias)
+                data['transfers'] = peer.list_transfers()
+
+            elif req_type == 'cancel_transfer':
+                alias = req_data['alias']
+                job_id = req_data['job_id']
+                peer = self.get_peer(alias)
+                peer.cancel_transfer(job_id)
 
             elif req_type == 'list_files':
                 alias = req_data['alias']
                 peer = self.get_peer(alias)
-                data['files'] = peer.list_files()
+
+                stream = ipc.Stream(client, req_id, 'files', peer.list_files(
+                    req_data.get('since'),
+                    req_data.get('before'),
+                    req_data.get('limit'),
+                    req_data.get('after')
+                ))
 
             elif req_type != 'stop':
                 raise Exception(f'Unrecognized message type: "{req_type}"')
 
-            self.send_to_client({
-                'error': None,
-                'data': data
-            })
+            if stream:
+                self.streams.append(stream)
+            else:
+                client.send({
+                    'id': req_id,
+                    'error': None,
+                    'data': data,
+                    'more': False
+                })
 
         except Exception as e:
-            self.send_to_client({
+            client.send({
+                'id': req_id,
                 'data': {},
-                'error': str(e)
+                'error': str(e),
+                'more': False
             })
 
-        return req_type == 'stop'
-
     def get_peer(self, alias):
-        try:
-            return self.peers[alias]
-
-        except KeyError:
+        if alias not in self.peers:
             raise Exception(f'Peer {alias} not found')
 
-    def send_to_client(self, msg):
-        payload = json.dumps(msg).encode()
-
-        try:
-            return self.server.sendto(payload, self.ipc_client_path)
-        except FileNotFoundError:
-            pass
+        return self.peers.get(alias)
 
 async def main():
     connect_peers = 'connect' in sys.argv[1:]
-    daemon = Daemon(connect_peers=connect_peers)
+    engine = 'asyncio' if 'asyncio' in sys.argv[1:] else 'thread'
+    fast_recv = 'fast_recv' in sys.argv[1:]
+    options = dict(arg.split('=', 1) for arg in sys.argv[1:] if '=' in arg)
+    recv_bufsize = int(options.get('recv_bufsize', const.DEFAULT_RECV_BUFSIZE))
+    durability = options.get('durability', const.DEFAULT_DURABILITY)
+    ident4_endpoint = options.get('ident4', const.DEFAULT_IDENT4_ENDPOINT)
+    ident6_endpoint = options.get('ident6', const.DEFAULT_IDENT6_ENDPOINT)
+    ready_fd = int(options['ready_fd']) if 'ready_fd' in options else None
+    server_fileno = int(options['server_fd']) if 'server_fd' in options else ipc.activated_fileno()
+    shared_port = int(options.get('shared_port', 0))
+    ping_timeout = float(options.get('ping_timeout', const.DEFAULT_PING_TIMEOUT))
+
+    daemon = Daemon(
+        connect_peers=connect_peers,
+        engine=engine,
+        fast_recv=fast_recv,
+        recv_bufsize=recv_bufsize,
+        durability=durability,
+        ident4_endpoint=ident4_endpoint,
+        ident6_endpoint=ident6_endpoint,
+        server_fileno=server_fileno,
+        shared_port=shared_port,
+        ping_timeout=ping_timeout
+    )
+
+    ipc.notify_ready(ready_fd)
 
     try:
         await daemon.run()
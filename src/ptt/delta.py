@@ -0,0 +1,161 @@
+import hashlib
+
+from ptt import const
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+GEAR = [
+    int.from_bytes(hashlib.blake2b(bytes([i]), digest_size=8).digest(), 'big')
+    for i in range(256)
+]
+
+MASK_64 = (1 << 64) - 1
+
+def bits_mask(bits):
+    return ((1 << bits) - 1) << (64 - bits)
+
+AVG_BITS = const.DELTA_AVG_CHUNK_SIZE.bit_length() - 1
+
+# Normalized chunking: a harder mask before the average size and an easier one
+# after it keeps chunk sizes close to the average.
+MASK_SMALL = bits_mask(AVG_BITS + 2)
+MASK_LARGE = bits_mask(AVG_BITS - 2)
+
+def chunk_hash(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def find_boundary(data, start, end):
+    min_end = start + const.DELTA_MIN_CHUNK_SIZE
+
+    if end <= min_end:
+        return end
+
+    normal_end = min(start + const.DELTA_AVG_CHUNK_SIZE, end)
+    max_end = min(start + const.DELTA_MAX_CHUNK_SIZE, end)
+
+    if numpy:
+        return find_boundary_numpy(data, min_end, normal_end, max_end)
+
+    gear = GEAR
+    fp = 0
+    i = min_end
+
+    for byte in data[min_end:normal_end]:
+        fp = ((fp << 1) + gear[byte]) & MASK_64
+        i += 1
+
+        if not fp & MASK_SMALL:
+            return i
+
+    for byte in data[normal_end:max_end]:
+        fp = ((fp << 1) + gear[byte]) & MASK_64
+        i += 1
+
+        if not fp & MASK_LARGE:
+            return i
+
+    return max_end
+
+if numpy:
+    GEAR_TABLE = numpy.array(GEAR, dtype=numpy.uint64)
+
+def gear_fingerprints(data):
+    # Each byte's contribution is shifted out after 64 steps, so the rolling
+    # fingerprint at every position is the sum of the last 64 shifted gear
+    # values. Build it by doubling the window: 1, 2, 4, ..., 64 bytes.
+    fps = GEAR_TABLE[numpy.frombuffer(data, dtype=numpy.uint8)]
+    span = 1
+
+    while span < 64:
+        fps[span:] += fps[:-span] << numpy.uint64(span)
+        span *= 2
+
+    return fps
+
+def find_boundary_numpy(data, min_end, normal_end, max_end):
+    pos = min_end
+
+    for mask, stop in ((MASK_SMALL, normal_end), (MASK_LARGE, max_end)):
+        while pos < stop:
+            scan_end = min(pos + const.DELTA_SCAN_SIZE, stop)
+            overlap = min(pos - min_end, 63)
+            fps = gear_fingerprints(data[pos - overlap:scan_end])[overlap:]
+            hits = numpy.flatnonzero((fps & numpy.uint64(mask)) == 0)
+
+            if len(hits):
+                return pos + int(hits[0]) + 1
+
+            pos = scan_end
+
+    return max_end
+
+def chunk_file(filepath):
+    chunks = []
+    data = bytearray()
+    start = 0
+
+    with open(filepath, 'rb') as file:
+        eof = False
+
+        while not eof or start < len(data):
+            if not eof and len(data) - start < const.DELTA_MAX_CHUNK_SIZE:
+                del data[:start]
+                start = 0
+                block = file.read(const.DELTA_READ_SIZE)
+                eof = not block
+                data += block
+                continue
+
+            with memoryview(data) as view:
+                while start < len(data) and (eof or len(data) - start >= const.DELTA_MAX_CHUNK_SIZE):
+                    end = find_boundary(view, start, len(data))
+                    chunks.append([end - start, chunk_hash(view[start:end])])
+                    start = end
+
+    return chunks
+
+def pages(items, size=const.DELTA_PAGE_SIZE):
+    start = 0
+
+    while True:
+        page = items[start:start + size]
+        start += size
+
+        yield page, start >= len(items)
+
+        if start >= len(items):
+            return
+
+def chunk_offsets(chunks):
+    offset = 0
+
+    for size, digest in chunks:
+        yield offset, size, digest
+        offset += size
+
+def plan_segments(chunks, have, offset):
+    have = set(have)
+    segments = []
+
+    for i, (chunk_offset, size, _) in enumerate(chunk_offsets(chunks)):
+        if chunk_offset + size <= offset:
+            continue
+
+        if i in have and chunk_offset >= offset:
+            segments.append((chunk_offset, size, True))
+            continue
+
+        start = max(chunk_offset, offset)
+        end = chunk_offset + size
+
+        if segments and not segments[-1][2]:
+            prev_offset, prev_size, _ = segments.pop()
+            start = prev_offset
+            end = max(end, prev_offset + prev_size)
+
+        segments.append((start, end - start, False))
+
+    return segments
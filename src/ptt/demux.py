@@ -0,0 +1,203 @@
+import ipaddress
+import secrets
+import socket
+import threading
+import time
+
+from ptt import conn, const
+
+NAME_PREFIX = 'ptt-'
+
+def new_token():
+    return secrets.token_hex(const.PEER_TOKEN_SIZE)
+
+def tls_name(token):
+    return f'{NAME_PREFIX}{token}'
+
+def parse_tls_name(name):
+    if not name or not name.startswith(NAME_PREFIX):
+        return None
+
+    return name[len(NAME_PREFIX):] or None
+
+def same_ip(a, b):
+    try:
+        return ipaddress.ip_address(a) == ipaddress.ip_address(b)
+    except ValueError:
+        return False
+
+def read_u16(data, pos):
+    return int.from_bytes(data[pos:pos + 2], 'big')
+
+def client_hello_name(data):
+    if len(data) < 5:
+        return None, False
+
+    if data[0] != 0x16:
+        return None, True
+
+    length = read_u16(data, 3)
+
+    if len(data) < 5 + length:
+        return None, False
+
+    hello = data[5:5 + length]
+
+    try:
+        if hello[0] != 1:
+            return None, True
+
+        # Skip the handshake header, version and random, then the session ID,
+        # cipher suites and compression methods.
+        pos = 38
+        pos += 1 + hello[pos]
+        pos += 2 + read_u16(hello, pos)
+        pos += 1 + hello[pos]
+        end = pos + 2 + read_u16(hello, pos)
+        pos += 2
+
+        while pos + 4 <= end:
+            ext_type = read_u16(hello, pos)
+            ext_len = read_u16(hello, pos + 2)
+            pos += 4
+
+            if ext_type == 0:
+                name_len = read_u16(hello, pos + 3)
+                return str(hello[pos + 5:pos + 5 + name_len], 'ascii'), True
+
+            pos += ext_len
+
+    except (IndexError, UnicodeDecodeError):
+        pass
+
+    return None, True
+
+def peek_tls_name(sock, timeout=const.DEMUX_TIMEOUT):
+    deadline = time.monotonic() + timeout
+
+    while True:
+        remaining = deadline - time.monotonic()
+
+        if remaining <= 0:
+            return None
+
+        sock.settimeout(remaining)
+
+        try:
+            data = sock.recv(const.DEMUX_PEEK_SIZE, socket.MSG_PEEK)
+        except OSError:
+            return None
+
+        if not data:
+            return None
+
+        name, complete = client_hello_name(data)
+
+        if complete:
+            return name
+
+        time.sleep(0.01)
+
+class SharedPort:
+    def __init__(self, daemon, port):
+        self.daemon = daemon
+        self.port = port
+        self.socks = []
+        self.closed = False
+
+    def start(self):
+        for family in (socket.AF_INET, socket.AF_INET6):
+            try:
+                sock = self.listen(family)
+            except OSError as e:
+                print(f'Failed to listen on shared port {self.port}: {e}')
+                continue
+
+            self.socks.append(sock)
+            threading.Thread(target=self.accept_loop, args=(sock,), daemon=True).start()
+
+        if not self.socks:
+            raise Exception(f'Failed to listen on shared port {self.port}')
+
+    def listen(self, family):
+        sock = socket.socket(family, socket.SOCK_STREAM)
+
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+            if family == socket.AF_INET6:
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+
+            sock.bind(('', self.port))
+            sock.listen(const.DEMUX_BACKLOG)
+            sock.settimeout(const.DEMUX_POLL_INTERVAL)
+        except OSError:
+            sock.close()
+            raise
+
+        return sock
+
+    def accept_loop(self, listener):
+        while not self.closed:
+            try:
+                sock, addr = listener.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+
+            threading.Thread(
+                target=self.route,
+                args=(sock, addr[:2], listener.family),
+                daemon=True
+            ).start()
+
+    def route(self, sock, addr, family):
+        try:
+            peer = self.find_peer(sock, *addr)
+            conn.tune_socket(sock)
+            peer_conn = peer and peer.conn
+
+            if peer_conn and peer_conn.offer(family, sock):
+                return
+
+        except Exception as e:
+            print(e)
+
+        sock.close()
+
+    def find_peer(self, sock, ip, port):
+        connecting = [peer for peer in self.daemon.peers.loaded() if peer.is_connecting()]
+        matches = []
+
+        for peer in connecting:
+            for remote_ip, remote_port in peer.remote_addrs():
+                if same_ip(ip, remote_ip):
+                    matches.append((peer, remote_port))
+
+        exact = [peer for peer, remote_port in matches if remote_port == port]
+
+        if len(exact) == 1:
+            return exact[0]
+
+        if len(matches) == 1:
+            return matches[0][0]
+
+        if not matches:
+            return None
+
+        # Several contacts share this address and the NAT rewrote the port, so
+        # look for the token the connecting side sent in its ClientHello.
+        token = parse_tls_name(peek_tls_name(sock))
+        named = {peer for peer, _ in matches if token and peer.token == token}
+
+        return named.pop() if len(named) == 1 else None
+
+    def close(self):
+        self.closed = True
+
+        for sock in self.socks:
+            sock.close()
+
+        self.socks = []
@@ -0,0 +1,50 @@
+import asyncio
+
+from ptt import const
+
+class Dispatcher:
+    def __init__(self, limit=const.MAX_CONCURRENT_TASKS, on_done=None):
+        self.limit = limit
+        self.on_done = on_done
+        self.slots = None
+        self.queues = {}
+        self.tasks = set()
+
+    def submit(self, key, coro):
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.limit)
+
+        if key not in self.queues:
+            self.queues[key] = [asyncio.Lock(), 0]
+
+        self.queues[key][1] += 1
+
+        task = asyncio.ensure_future(self.run(key, coro))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+        if self.on_done:
+            task.add_done_callback(self.on_done)
+
+        return task
+
+    async def run(self, key, coro):
+        queue = self.queues[key]
+
+        try:
+            async with queue[0]:
+                async with self.slots:
+                    await coro
+
+        except Exception as e:
+            print(e)
+
+        finally:
+            queue[1] -= 1
+
+            if not queue[1]:
+                del self.queues[key]
+
+    async def join(self):
+        while self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
@@ -0,0 +1,204 @@
+import struct
+import zlib
+
+from ptt import const
+
+HEADER = struct.Struct('!I')
+COMPRESSED = 0x80000000
+
+BINARY_VERSION = 2
+BINARY_HEADER = struct.Struct('!BBB')
+FLAG_COMPRESSED = 0x01
+
+JSON = 0
+
+class FrameDecoder:
+    def __init__(
+            self,
+            *,
+            bufsize=const.DEFAULT_RECV_BUFSIZE,
+            max_frame_size=const.MAX_FRAME_SIZE
+    ):
+        self.buf = bytearray(bufsize)
+        self.bufsize = bufsize
+        self.max_frame_size = max_frame_size
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def reserve(self, nbytes):
+        if len(self.buf) - self.end >= nbytes:
+            return
+
+        used = self.end - self.start
+
+        if used + nbytes <= len(self.buf):
+            self.buf[:used] = self.buf[self.start:self.end]
+        else:
+            buf = bytearray(max(2 * len(self.buf), used + nbytes))
+            buf[:used] = self.buf[self.start:self.end]
+            self.buf = buf
+
+        self.start = 0
+        self.end = used
+
+    def get_buffer(self):
+        self.reserve(self.bufsize)
+
+        return memoryview(self.buf)[self.end:]
+
+    def buffer_updated(self, nbytes):
+        self.end += nbytes
+
+    def recv_into(self, conn):
+        with self.get_buffer() as free:
+            nread = conn.recv_into(free, len(free))
+
+        self.buffer_updated(nread)
+
+        return nread
+
+    def feed(self, data):
+        nbytes = len(data)
+
+        self.reserve(nbytes)
+        self.buf[self.end:self.end + nbytes] = data
+        self.end += nbytes
+
+    def consume(self, nbytes):
+        buf = self.buf
+        start = self.start
+        self.start += nbytes
+
+        if self.start == self.end:
+            self.start = self.end = 0
+
+            if len(buf) > self.bufsize:
+                self.buf = bytearray(self.bufsize)
+
+        return memoryview(buf)[start:start + nbytes]
+
+    def next_frame(self):
+        used = self.end - self.start
+
+        if not used:
+            return None
+
+        if self.buf[self.start] == BINARY_VERSION:
+            return self.next_binary_frame(used)
+
+        if used < HEADER.size:
+            return None
+
+        size = HEADER.unpack_from(self.buf, self.start)[0]
+        compressed = size & COMPRESSED
+        size &= ~COMPRESSED
+
+        if size > self.max_frame_size:
+            raise Exception(f'Frame size {size} exceeds maximum of {self.max_frame_size}')
+
+        if used < HEADER.size + size:
+            self.reserve(HEADER.size + size - used)
+            return None
+
+        self.start += HEADER.size
+
+        if compressed:
+            return JSON, self.decompress(self.consume(size))
+
+        return JSON, self.consume(size)
+
+    def next_binary_frame(self, used):
+        if used < BINARY_HEADER.size + 1:
+            return None
+
+        _, kind, flags = BINARY_HEADER.unpack_from(self.buf, self.start)
+        pos = self.start + BINARY_HEADER.size
+        size = 0
+        shift = 0
+
+        while True:
+            if pos >= self.end:
+                return None
+
+            byte = self.buf[pos]
+            size |= (byte & 0x7f) << shift
+            pos += 1
+            shift += 7
+
+            if not byte & 0x80:
+                break
+
+            if shift > 28:
+                raise Exception('Malformed frame length')
+
+        if size > self.max_frame_size:
+            raise Exception(f'Frame size {size} exceeds maximum of {self.max_frame_size}')
+
+        header_size = pos - self.start
+
+        if used < header_size + size:
+            self.reserve(header_size + size - used)
+            return None
+
+        self.start = pos
+
+        if flags & FLAG_COMPRESSED:
+            return kind, self.decompress(self.consume(size))
+
+        return kind, self.consume(size)
+
+    def decompress(self, frame):
+        decompressor = zlib.decompressobj()
+        payload = decompressor.decompress(frame, self.max_frame_size)
+
+        if decompressor.unconsumed_tail:
+            raise Exception(f'Decompressed frame exceeds maximum of {self.max_frame_size}')
+
+        return payload
+
+    def frames(self):
+        while True:
+            frame = self.next_frame()
+
+            if frame is None:
+                return
+
+            yield frame
+
+    def take(self, nbytes):
+        return self.consume(min(nbytes, self.end - self.start))
+
+def encode_frame(payload, compress=False):
+    if compress and len(payload) >= const.COMPRESS_MIN_SIZE:
+        compressed = zlib.compress(payload, const.COMPRESS_LEVEL)
+
+        if len(compressed) < len(payload):
+            return HEADER.pack(len(compressed) | COMPRESSED) + compressed
+
+    return HEADER.pack(len(payload)) + payload
+
+def encode_varint(value):
+    out = bytearray()
+
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+
+    out.append(value)
+
+    return bytes(out)
+
+def encode_binary_frame(kind, body, compress=False):
+    flags = 0
+
+    if compress and len(body) >= const.COMPRESS_MIN_SIZE:
+        compressed = zlib.compress(body, const.COMPRESS_LEVEL)
+
+        if len(compressed) < len(body):
+            body = compressed
+            flags |= FLAG_COMPRESSED
+
+    return BINARY_HEADER.pack(BINARY_VERSION, kind, flags) + encode_varint(len(body)) + body
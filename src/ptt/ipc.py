@@ -0,0 +1,159 @@
+import collections
+import json
+import os
+import socket
+
+from ptt import const, framing
+
+class Channel:
+    def __init__(self, sock):
+        self.sock = sock
+        self.decoder = framing.FrameDecoder(bufsize=const.IPC_BUFSIZE)
+        self.pending = collections.deque()
+        self.outbuf = bytearray()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, msg):
+        self.outbuf += framing.encode_frame(json.dumps(msg).encode())
+        self.flush()
+
+    def flush(self):
+        while self.outbuf:
+            try:
+                nsent = self.sock.send(self.outbuf)
+            except BlockingIOError:
+                return
+
+            del self.outbuf[:nsent]
+
+    def recv(self):
+        try:
+            if not self.decoder.recv_into(self.sock):
+                return None
+        except BlockingIOError:
+            return []
+
+        return [json.loads(str(payload, 'utf8')) for _, payload in self.decoder.frames()]
+
+    def next_message(self):
+        while not self.pending:
+            msgs = self.recv()
+
+            if msgs is None:
+                raise Exception('Daemon closed the connection')
+
+            self.pending.extend(msgs)
+
+        return self.pending.popleft()
+
+    def close(self):
+        self.sock.close()
+
+class Stream:
+    def __init__(self, channel, req_id, key, rows):
+        self.channel = channel
+        self.req_id = req_id
+        self.key = key
+        self.rows = iter(rows)
+        self.next_row = None
+        self.done = False
+
+    def next_page(self):
+        page = []
+        page_size = 0
+
+        if self.next_row is not None:
+            page.append(self.next_row)
+            page_size = len(json.dumps(self.next_row))
+            self.next_row = None
+
+        for row in self.rows:
+            row_size = len(json.dumps(row))
+
+            if page and page_size + row_size > const.IPC_PAGE_SIZE:
+                self.next_row = row
+                return page
+
+            page.append(row)
+            page_size += row_size
+
+        self.done = True
+
+        return page
+
+    def send_page(self):
+        try:
+            page = self.next_page()
+        except Exception as e:
+            self.done = True
+
+            return self.channel.send({
+                'id': self.req_id,
+                'data': {},
+                'error': str(e),
+                'more': False
+            })
+
+        self.channel.send({
+            'id': self.req_id,
+            'error': None,
+            'data': {self.key: page},
+            'more': not self.done
+        })
+
+def listen(path, fileno=None):
+    if fileno is not None:
+        return socket.socket(fileno=fileno)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen()
+
+    return server
+
+def activated_fileno():
+    if os.environ.get('LISTEN_PID') != str(os.getpid()):
+        return None
+
+    if int(os.environ.get('LISTEN_FDS', 0)) < 1:
+        return None
+
+    return const.SD_LISTEN_FDS_START
+
+def notify_ready(ready_fd=None):
+    if ready_fd is not None:
+        os.write(ready_fd, b'1')
+        os.close(ready_fd)
+
+    path = os.environ.get('NOTIFY_SOCKET')
+
+    if not path:
+        return
+
+    if path.startswith('@'):
+        path = '\0' + path[1:]
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(b'READY=1', path)
+    except OSError as e:
+        print(e)
+
+def accept(server):
+    sock, _ = server.accept()
+    sock.setblocking(False)
+
+    return Channel(sock)
+
+def connect(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        raise Exception('Daemon not running')
+
+    return Channel(sock)
@@ -0,0 +1,226 @@
+import collections
+import os
+import threading
+
+from ptt import const
+
+class FileStream:
+    def __init__(self, job, file, encode, segments=None, codec=None):
+        self.id = job.id
+        self.job = job
+        self.file = file
+        self.encode = encode
+        self.offset = job.msg_data['offset']
+        self.filesize = job.msg_data['filesize']
+        self.codec = codec
+        self.compressible = True
+        self.nchunks = 0
+        self.wire_size = 0
+        self.done = threading.Event()
+        self.error = None
+
+        job.codec = codec and codec.name
+
+        if segments is None:
+            segments = [(self.offset, self.filesize - self.offset, False)]
+
+        self.segments = collections.deque(segment for segment in segments if segment[1])
+
+    def head(self):
+        offset, size, copy = self.segments[0]
+
+        return offset, size if copy else min(const.FILE_CHUNK_SIZE, size), copy
+
+    def next_chunk(self):
+        offset, size, copy = self.head()
+        msg_data = {'id': self.id, 'offset': offset, 'size': size}
+
+        if copy:
+            self.wire_size = 0
+            return self.encode('copy', msg_data), offset, 0, None
+
+        compressed = self.compress(offset, size)
+
+        if compressed is None:
+            self.wire_size = size
+            return self.encode('chunk', msg_data), offset, size, None
+
+        msg_data['size'] = len(compressed)
+        msg_data['length'] = size
+        msg_data['codec'] = self.codec.name
+
+        self.wire_size = len(compressed)
+
+        return self.encode('chunk', msg_data), offset, size, compressed
+
+    def compress(self, offset, size):
+        if not self.codec:
+            return None
+
+        probe = self.nchunks % const.COMPRESS_PROBE_INTERVAL == 0
+        self.nchunks += 1
+
+        if not (self.compressible or probe):
+            return None
+
+        compressed = self.codec.compress(os.pread(self.file.fileno(), size, offset))
+        self.compressible = len(compressed) <= size * const.COMPRESS_MIN_RATIO
+
+        return compressed if self.compressible else None
+
+    def advance(self):
+        offset, size, copy = self.head()
+        _, remaining, _ = self.segments.popleft()
+
+        if size < remaining:
+            self.segments.appendleft((offset + size, remaining - size, copy))
+
+        if not copy:
+            self.job.record_payload(size, self.wire_size)
+
+        self.offset = offset + size
+        self.job.progress(self.offset)
+
+        return not self.segments
+
+    def finish(self, error=None):
+        self.error = error
+        self.done.set()
+
+    def wait(self):
+        self.done.wait()
+
+        if self.error:
+            raise self.error
+
+class Outbox:
+    def __init__(self, peer):
+        self.peer = peer
+        self.closed = False
+        self.cond = threading.Condition()
+        self.frames = collections.deque()
+        self.queued = 0
+        self.streams = collections.deque()
+        self.writing = False
+
+    def send(self, data, bounded=False):
+        with self.cond:
+            if self.closed:
+                raise Exception(f'Peer {self.peer.alias} isn\'t connected')
+
+            if bounded and self.queued + len(data) > const.SEND_QUEUE_MAX:
+                raise Exception(f'Peer {self.peer.alias} is busy')
+
+            self.frames.append(data)
+            self.queued += len(data)
+            self.cond.notify_all()
+
+    def add_stream(self, stream):
+        with self.cond:
+            if self.closed:
+                raise Exception(f'Peer {self.peer.alias} isn\'t connected')
+
+            self.streams.append(stream)
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            streams = list(self.streams)
+            self.streams.clear()
+            self.frames.clear()
+            self.queued = 0
+            self.cond.notify_all()
+
+        for stream in streams:
+            stream.finish(Exception(f'Peer {self.peer.alias}: connection closed'))
+
+    def next_item(self):
+        with self.cond:
+            while not (self.closed or self.frames or self.streams):
+                self.cond.wait()
+
+            if self.closed:
+                return None
+
+            if self.frames:
+                self.writing = True
+                return self.next_frames()
+
+            return self.streams.popleft()
+
+    def next_frames(self):
+        frames = [self.frames.popleft()]
+        size = len(frames[0])
+
+        while self.frames and size + len(self.frames[0]) <= const.SEND_COALESCE_SIZE:
+            frame = self.frames.popleft()
+            frames.append(frame)
+            size += len(frame)
+
+        self.queued -= size
+
+        return frames
+
+    def wait_sent(self, timeout):
+        with self.cond:
+            self.cond.wait_for(lambda: self.closed or not (self.frames or self.writing), timeout)
+
+    def sent(self):
+        with self.cond:
+            self.writing = False
+            self.cond.notify_all()
+
+    def requeue(self, stream):
+        with self.cond:
+            if self.closed:
+                return False
+
+            self.streams.append(stream)
+
+            return True
+
+    def fail(self, error):
+        if not self.closed:
+            print(error)
+            self.peer.disconnect()
+
+    def run(self, conn):
+        while True:
+            item = self.next_item()
+
+            if item is None:
+                return
+
+            if not isinstance(item, FileStream):
+                try:
+                    conn.sendmsg(item)
+                except Exception as e:
+                    self.fail(e)
+                    return
+
+                self.sent()
+                continue
+
+            try:
+                header, offset, size, payload = item.next_chunk()
+
+                if payload is not None:
+                    conn.sendmsg([header, payload])
+                elif size:
+                    conn.sendmsg([header], more=True)
+                    conn.sendfile(item.file, offset, size)
+                else:
+                    conn.sendmsg([header])
+            except Exception as e:
+                item.finish(e)
+                self.fail(e)
+                return
+
+            try:
+                if item.advance():
+                    item.finish()
+                elif not self.requeue(item):
+                    item.finish(Exception(f'Peer {self.peer.alias}: connection closed'))
+            except Exception as e:
+                item.finish(e)
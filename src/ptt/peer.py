@@ -1,31 +1,50 @@
 import ipaddress
-import json
 import os
 import socket
-import struct
 import threading
 import time
 
-from ptt import conn
+from ptt import codec, conn, const, delta, demux, framing, outbox, transfer, wire
 
 class Peer:
     def __init__(
             self, daemon, alias,
-            local_port=0, remote_ip=None, remote_port=0
+            local_port=0, remote_ip=None, remote_port=0, alt_ip='', token='', remote_token=''
     ):
         self.daemon = daemon
 
         self.alias = alias
         self.conn = None
         self.is_ipv6 = remote_ip and ipaddress.ip_address(remote_ip).version == 6
-        self.local_port = local_port
+        self.shared = local_port is None
+        self.local_port = daemon.shared_port if self.shared else local_port
         self.remote_ip = remote_ip
         self.remote_port = remote_port
+        self.alt_ip = alt_ip
+        self.token = token or demux.new_token()
+        self.remote_token = remote_token
+        self.outbox = None
+        self.peer_codecs = []
+        self.peer_version = 1
+        self.peer_heartbeat = False
+        self.recvchunk = None
         self.sock = None
+        self.tls_session = None
         self.state = ''
         self.state_lock = threading.Lock()
+        self.incoming = {}
+        self.stripes = {}
+        self.reconnect = False
+        self.run_id = 0
+        self.attempts = 0
+        self.rtt = None
+        self.connected_at = None
+        self.last_recv = 0
 
     def init(self, is_ipv6=False, new_port=False):
+        if self.daemon.shared_port:
+            return self.share_port(is_ipv6)
+
         for _ in range(1, 10):
             family = socket.AF_INET6 if is_ipv6 else socket.AF_INET
             sock = socket.socket(family, socket.SOCK_STREAM)
@@ -37,13 +56,17 @@ class Peer:
                 sock.bind(('', 0 if new_port else self.local_port))
                 local_port = sock.getsockname()[1]
 
-                if not self.local_port:
-                    self.daemon.db_write(f'INSERT INTO peers VALUES ("{self.alias}", {local_port}, "", 0)')
+                if not self.local_port and not self.shared:
+                    self.daemon.db_write(
+                        'INSERT INTO peers (alias, local_port, remote_ip, remote_port, alt_ip, token) VALUES (?, ?, ?, ?, ?, ?)',
+                        (self.alias, local_port, '', 0, '', self.token)
+                    )
                     self.local_port = local_port
                 else:
                     self.edit(local_port=local_port)
 
                 self.is_ipv6 = is_ipv6
+                self.shared = False
                 self.sock = sock
 
                 return local_port
@@ -53,6 +76,25 @@ class Peer:
 
         raise Exception(f'Peer {self.alias}: failed to find available TCP port')
 
+    def share_port(self, is_ipv6):
+        if self.local_port or self.shared:
+            self.daemon.db_write('UPDATE peers SET local_port = NULL WHERE alias = ?', (self.alias,))
+        else:
+            self.daemon.db_write(
+                'INSERT INTO peers (alias, local_port, remote_ip, remote_port, alt_ip, token) VALUES (?, ?, ?, ?, ?, ?)',
+                (self.alias, None, '', 0, '', self.token)
+            )
+
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+        self.is_ipv6 = is_ipv6
+        self.shared = True
+        self.local_port = self.daemon.shared_port
+
+        return self.local_port
+
     def setstate(self, state=''):
         self.state_lock.acquire()
         self.state = state
@@ -65,15 +107,52 @@ class Peer:
 
         return state or 'not connected'
 
+    def is_reconnecting(self):
+        return self.getstate() == 'reconnecting'
+
     def run(self):
+        self.run_id += 1
+        run_id = self.run_id
+        timeout = None
+
+        while True:
+            connected = self.run_session(timeout)
+
+            # The first attempt runs until it's hung up, failed reconnects back off and retry.
+            if not connected and timeout is None:
+                return
+
+            delay = self.reconnect_delay(connected)
+
+            if delay is None:
+                return
+
+            time.sleep(delay)
+
+            if not self.resume_connecting(run_id):
+                return
+
+            timeout = const.RECONNECT_ATTEMPT_TIMEOUT
+
+    def run_session(self, timeout=None):
+        # The peer's hello can arrive as soon as the connection is up.
+        self.reset_hello()
+
         try:
             self.conn = conn.Conn(self)
-            self.conn.connect()
+            self.conn.connect(timeout)
         except Exception as e:
             self.disconnect()
             print(e)
 
-            return
+            return False
+
+        self.outbox = outbox.Outbox(self)
+        threading.Thread(target=self.outbox.run, args=(self.conn,), daemon=True).start()
+        threading.Thread(target=self.heartbeat, args=(self.conn,), daemon=True).start()
+
+        self.start_session()
+        self.send_hello()
 
         self.daemon.recvd.put({
             'type': 'connect',
@@ -81,40 +160,99 @@ class Peer:
             'data': {}
         })
 
-        data = bytes()
-        size = 0
+        self.recv_loop()
+        self.close_transfers()
+        self.disconnect()
 
-        def handle_chunk(chunk=bytes()):
-            nonlocal data
-            nonlocal size
+        self.daemon.recvd.put({
+            'type': 'disconnect',
+            'peer': self.alias,
+            'data': {}
+        })
 
-            if chunk:
-                data += chunk
+        return True
 
-            if size == 0 and len(data) >= 4:
-                size = struct.unpack_from('!I', data)[0]
+    def start_session(self):
+        self.reconnect = True
+        self.rtt = None
+        self.connected_at = self.last_recv = time.monotonic()
 
-            if len(data) - 4 >= size > 0:
-                payload = data[4: 4 + size]
-                data = data[4 + size:]
-                size = 0
+    def reconnect_delay(self, connected):
+        if connected and time.monotonic() - self.connected_at >= const.RECONNECT_RESET_TIME:
+            self.attempts = 0
 
-                try:
-                    msg = json.loads(payload.decode())
-                    msg['peer'] = self.alias
+        with self.state_lock:
+            if not self.reconnect or self.state:
+                return None
 
-                    if msg['type'] == 'file':
-                        data = self.handle_file(data, msg['data'])
+            self.state = 'reconnecting'
 
-                    self.daemon.recvd.put(msg)
-                except Exception as e:
-                    print(e)
+        delay = min(const.RECONNECT_MIN * 2 ** self.attempts, const.RECONNECT_MAX)
+        self.attempts += 1
+
+        print(f'Peer {self.alias}: reconnecting in {delay}s (attempt {self.attempts})')
+
+        return conn.retry_delay(delay)
+
+    def resume_connecting(self, run_id):
+        with self.state_lock:
+            if self.state != 'reconnecting' or not self.reconnect or run_id != self.run_id:
+                return False
+
+            self.state = 'connecting'
 
-                handle_chunk()
+        return True
+
+    def heartbeat(self, peer_conn):
+        interval = self.daemon.ping_timeout / const.PINGS_PER_TIMEOUT
+
+        try:
+            while True:
+                time.sleep(interval)
+
+                if not self.beat(peer_conn):
+                    return
+
+        except Exception as e:
+            print(e)
+
+    def beat(self, peer_conn):
+        if self.conn is not peer_conn or not self.is_connected():
+            return False
+
+        if not self.peer_heartbeat:
+            return True
+
+        if time.monotonic() - self.last_recv > self.daemon.ping_timeout:
+            print(f'Peer {self.alias}: no response in {self.daemon.ping_timeout}s')
+            peer_conn.abort()
+
+            return False
+
+        self.sendmessage('ping', {'sent_at': time.monotonic()})
+
+        return True
+
+    def supervisor_state(self):
+        uptime = None
+
+        if self.is_connected() and self.connected_at is not None:
+            uptime = time.monotonic() - self.connected_at
+
+        return {'attempts': self.attempts, 'rtt': self.rtt, 'uptime': uptime}
+
+    def recv_loop(self):
+        decoder = framing.FrameDecoder(bufsize=self.daemon.recv_bufsize)
 
         while self.is_connected():
+            direct = self.direct_buffer(decoder)
+
             try:
-                chunk = self.recv()
+                if direct is None:
+                    nread = decoder.recv_into(self)
+                else:
+                    with direct:
+                        nread = self.recv_into(direct, len(direct))
 
             except TimeoutError:
                 continue
@@ -123,22 +261,31 @@ class Peer:
                 print(e)
                 break
 
-            if not chunk:
+            if not nread:
                 break
 
-            handle_chunk(chunk)
-
-        self.disconnect()
+            self.last_recv = time.monotonic()
 
-        self.daemon.recvd.put({
-            'type': 'disconnect',
-            'peer': self.alias,
-            'data': {}
-        })
+            try:
+                if direct is None:
+                    self.handle_data(decoder)
+                else:
+                    self.handle_direct(nread)
+            except Exception as e:
+                print(e)
+                break
 
     def remote_addr(self):
         return (self.remote_ip, self.remote_port)
 
+    def remote_addrs(self):
+        addrs = [self.remote_addr()]
+
+        if self.alt_ip:
+            addrs.append((self.alt_ip, self.remote_port))
+
+        return addrs
+
     def server_side(self):
         if self.remote_port > self.local_port:
             return True
@@ -154,48 +301,343 @@ class Peer:
     def is_connecting(self):
         return self.getstate() == 'connecting'
 
-    def handle_file(self, data, msg_data):
-        filename = msg_data['filename']
-        filesize = msg_data['filesize']
+    def handle_data(self, decoder):
+        while True:
+            if self.recvchunk:
+                view = decoder.take(self.recvchunk['remaining'])
+
+                if not view:
+                    return
+
+                self.handle_chunk_data(view)
+                continue
+
+            frame = decoder.next_frame()
+
+            if frame is None:
+                return
+
+            try:
+                msg = wire.decode(*frame)
+                msg['peer'] = self.alias
+
+                if msg['type'] == 'file':
+                    self.handle_file(msg)
+                elif msg['type'] == 'chunk':
+                    self.handle_chunk(msg['data'])
+                elif msg['type'] == 'hello':
+                    self.peer_codecs = msg['data']['codecs']
+                    self.peer_version = msg['data'].get('version', 1)
+                    self.peer_heartbeat = msg['data'].get('heartbeat', False)
+                elif msg['type'] == 'ping':
+                    self.sendmessage('pong', msg['data'])
+                elif msg['type'] == 'pong':
+                    self.rtt = time.monotonic() - msg['data']['sent_at']
+                elif msg['type'] == 'bye':
+                    self.reconnect = False
+                elif msg['type'] == 'copy':
+                    self.handle_copy(msg['data'])
+                elif msg['type'] == 'stripe':
+                    self.accept_stripes(msg['data'])
+                elif msg['type'] == 'chunks':
+                    self.handle_chunk_list(msg['data'])
+                elif msg['type'] == 'have':
+                    self.daemon.transfers.have(msg['data']['id'], msg['data']['chunks'], msg['data']['last'])
+                elif msg['type'] == 'index':
+                    print(f'Peer {self.alias}: ignoring unexpected index message')
+                elif msg['type'] == 'cancel':
+                    self.cancel_incoming(msg['data']['id'])
+                    self.daemon.recvd.put(msg)
+                else:
+                    self.daemon.recvd.put(msg)
+            except Exception as e:
+                print(e)
+
+    def direct_buffer(self, decoder):
+        if not self.daemon.fast_recv or len(decoder) or not self.recvchunk:
+            return None
 
-        peer_files_path = os.path.join(self.daemon.files_path, self.alias)
+        if self.recvchunk['decompressor']:
+            return None
 
-        if not os.path.isdir(peer_files_path):
-            os.mkdir(peer_files_path)
+        incoming = self.recvchunk['transfer']
+        remaining = self.recvchunk['remaining']
 
-        msg_data['filepath'] = os.path.join(peer_files_path, filename)
+        # Nothing else is buffered, so the rest of the chunk can be read in one go. That only
+        # pays off when it's at least as much as a buffered read would take.
+        if not incoming or remaining < self.daemon.recv_bufsize:
+            return None
 
-        with open(msg_data['filepath'], 'wb') as file:
-            nread = min(len(data), filesize)
+        return incoming.view(remaining)
 
-            if nread:
-                file.write(data[:nread])
-                data = data[nread:]
+    def handle_direct(self, nbytes):
+        self.recvchunk['transfer'].received(nbytes)
+        self.chunk_received(nbytes)
 
-            while nread < filesize:
-                chunk = self.recv()
+    def handle_file(self, msg):
+        transfer_id = msg['data']['id']
+        transfer.check_transfer_id(transfer_id)
 
-                if not chunk:
-                    raise Exception(f'Peer {self.alias}: connection closed while reading file data')
+        if transfer_id in self.incoming:
+            self.incoming.pop(transfer_id).close()
 
-                file.write(chunk)
-                nread += len(chunk)
+        ready = self.stripes.pop(transfer_id, None)
 
-        return data
+        if 'stripes' in msg['data']:
+            incoming = transfer.StripedTransfer(self.daemon.files_path, self.alias, msg)
+        elif self.daemon.fast_recv:
+            incoming = transfer.DirectTransfer(self.daemon.files_path, self.alias, msg)
+        else:
+            incoming = transfer.IncomingTransfer(self.daemon.files_path, self.alias, msg)
+
+        self.incoming[transfer_id] = incoming
+
+        if ready:
+            ready['transfer'] = incoming
+            ready['event'].set()
+
+        self.daemon.recvd.put({
+            'type': 'transfer',
+            'peer': self.alias,
+            'data': msg['data']
+        })
+
+        if incoming.is_complete():
+            self.finish_transfer(incoming)
+
+    def handle_chunk(self, msg_data):
+        transfer_id = msg_data['id']
+        incoming = self.incoming.get(transfer_id)
+
+        self.recvchunk = {
+            'transfer': incoming,
+            'remaining': msg_data['size'],
+            'decompressor': None,
+            'length': msg_data.get('length', msg_data['size'])
+        }
+
+        if not incoming:
+            print(f'Peer {self.alias}: discarding chunk for unknown transfer {transfer_id}')
+
+        elif incoming.offset != msg_data['offset']:
+            print(f'Peer {self.alias}: discarding chunk at unexpected offset for transfer {transfer_id}')
+            self.recvchunk['transfer'] = None
+
+        elif 'codec' in msg_data:
+            self.recvchunk['decompressor'] = codec.decompressor(msg_data['codec'])
+
+            if not self.recvchunk['decompressor']:
+                print(f'Peer {self.alias}: discarding chunk with unsupported codec for transfer {transfer_id}')
+                self.recvchunk['transfer'] = None
+
+    def handle_chunk_list(self, msg_data):
+        transfer_id = msg_data['id']
+        incoming = self.incoming.get(transfer_id)
+
+        if not incoming or incoming.chunks is None:
+            print(f'Peer {self.alias}: discarding chunk list for unknown transfer {transfer_id}')
+            return
+
+        incoming.chunks.extend(msg_data['chunks'])
+
+        if len(incoming.chunks) > incoming.filesize // const.DELTA_MIN_CHUNK_SIZE + 1:
+            incoming.chunks = None
+            raise Exception(f'Transfer {transfer_id}: chunk list is longer than the file allows')
+
+        if not msg_data['last']:
+            return
+
+        chunks = incoming.chunks
+        incoming.chunks = None
+
+        self.daemon.recvd.put({
+            'type': 'delta',
+            'peer': self.alias,
+            'data': {'id': transfer_id, 'chunks': chunks}
+        })
+
+    def handle_copy(self, msg_data):
+        transfer_id = msg_data['id']
+        transfer.check_transfer_id(transfer_id)
+        incoming = self.incoming.get(transfer_id)
+
+        if not incoming:
+            print(f'Peer {self.alias}: discarding copy for unknown transfer {transfer_id}')
+            return
+
+        if incoming.offset != msg_data['offset']:
+            print(f'Peer {self.alias}: discarding copy at unexpected offset for transfer {transfer_id}')
+            return
+
+        try:
+            data = incoming.read_copy(msg_data['offset'], msg_data['size'])
+        except Exception:
+            self.cancel_incoming(transfer_id)
+            raise
+
+        incoming.write(data)
+        self.transfer_advanced(incoming)
+
+    def handle_chunk_data(self, view):
+        recvchunk = self.recvchunk
+        incoming = recvchunk['transfer']
+        decompressor = recvchunk['decompressor']
+
+        if incoming and decompressor:
+            data = decompressor.decompress(view, recvchunk['length'] + 1)
+            recvchunk['length'] -= len(data)
+
+            if recvchunk['length'] < 0 or (len(view) == recvchunk['remaining'] and recvchunk['length']):
+                raise Exception(f'Transfer {incoming.id}: chunk decompressed to unexpected length')
+
+            incoming.write(data)
+
+        elif incoming:
+            incoming.write(view)
+
+        self.chunk_received(len(view))
+
+    def chunk_received(self, nbytes):
+        incoming = self.recvchunk['transfer']
+        self.recvchunk['remaining'] -= nbytes
+
+        if self.recvchunk['remaining']:
+            return
+
+        self.recvchunk = None
+
+        if incoming:
+            self.transfer_advanced(incoming)
+
+    def transfer_advanced(self, incoming):
+        if incoming.is_complete():
+            self.finish_transfer(incoming)
+
+        elif incoming.should_checkpoint():
+            self.checkpoint_transfer(incoming)
+
+    def checkpoint_transfer(self, incoming):
+        incoming.checkpoint()
+        self.post_progress(incoming)
+
+    def accept_stripes(self, msg_data):
+        ready = {'event': threading.Event(), 'transfer': None}
+        self.stripes[msg_data['id']] = ready
+
+        for index in range(1, min(msg_data['count'], const.MAX_STRIPES) + 1):
+            threading.Thread(target=self.recv_stripe, args=(index, ready), daemon=True).start()
+
+    def recv_stripe(self, index, ready):
+        stripe = conn.StripeConn(self, index)
+
+        try:
+            stripe.connect()
+
+            if not ready['event'].wait(const.STRIPE_CONNECT_TIMEOUT):
+                raise Exception(f'Peer {self.alias}: stripe {index} opened for unknown transfer')
+
+            incoming = ready['transfer']
+
+            if index in getattr(incoming, 'lanes', {}):
+                self.recv_lane(stripe, incoming, index)
+
+        except Exception as e:
+            print(e)
+
+        finally:
+            stripe.close()
+
+    def recv_lane(self, stripe, incoming, index):
+        decoder = framing.FrameDecoder(bufsize=self.daemon.recv_bufsize)
+        offset = 0
+        remaining = 0
+
+        while not incoming.lane_complete(index):
+            if not decoder.recv_into(stripe):
+                raise Exception(f'Transfer {incoming.id}: stripe {index} closed early')
+
+            while True:
+                if remaining:
+                    view = decoder.take(remaining)
+
+                    if not view:
+                        break
+
+                    incoming.write_at(index, offset, view)
+                    offset += len(view)
+                    remaining -= len(view)
+
+                    if not remaining:
+                        self.lane_advanced(incoming)
+
+                    continue
+
+                frame = decoder.next_frame()
+
+                if frame is None:
+                    break
+
+                msg = wire.decode(*frame)
+                msg_data = msg['data']
+
+                if msg['type'] != 'chunk' or msg_data['id'] != incoming.id or 'codec' in msg_data:
+                    raise Exception(f'Transfer {incoming.id}: unexpected {msg["type"]} message on stripe {index}')
+
+                offset = msg_data['offset']
+                remaining = msg_data['size']
+
+    def lane_advanced(self, incoming):
+        if incoming.take_finish():
+            self.finish_transfer(incoming)
+
+        elif incoming.should_checkpoint():
+            incoming.checkpoint()
+            self.post_progress(incoming)
+
+    def finish_transfer(self, incoming):
+        self.incoming.pop(incoming.id, None)
+
+        incoming.finish()
+
+        self.daemon.recvd.put(incoming.msg)
+
+    def post_progress(self, incoming):
+        self.daemon.recvd.put({
+            'type': 'progress',
+            'peer': self.alias,
+            'data': {
+                'id': incoming.id,
+                'offset': incoming.durable
+            }
+        })
+
+    def close_transfers(self):
+        transfers = list(self.incoming.values())
+        self.incoming = {}
+        self.stripes = {}
+        self.recvchunk = None
+
+        for incoming in transfers:
+            try:
+                incoming.close()
+                self.post_progress(incoming)
+            except Exception as e:
+                print(e)
 
     def edit(self, **kwargs):
-        sql = ' '.join([
-            'UPDATE peers SET',
+        # An empty alt_ip clears it; None leaves it as is.
+        updates = [(key, val) for key, val in kwargs.items() if val or (key == 'alt_ip' and val == '')]
 
-            ', '.join([
-                f'{key} = "{val}"' if isinstance(val, str) else f'{key} = {val}'
-                for key, val in kwargs.items() if val
-            ]),
+        if not updates:
+            return
 
-            f'WHERE alias = "{self.alias}"'
+        sql = ' '.join([
+            'UPDATE peers SET',
+            ', '.join([f'{key} = ?' for key, _ in updates]),
+            'WHERE alias = ?'
         ])
 
-        self.daemon.db_write(sql)
+        self.daemon.db_write(sql, (*[val for _, val in updates], self.alias))
 
         if 'alias' in kwargs and kwargs['alias']:
             self.alias = kwargs['alias']
@@ -209,7 +651,14 @@ class Peer:
         if 'remote_port' in kwargs and kwargs['remote_port']:
             self.remote_port = kwargs['remote_port']
 
+        if 'alt_ip' in kwargs and kwargs['alt_ip'] is not None:
+            self.alt_ip = kwargs['alt_ip']
+
+        if 'remote_token' in kwargs and kwargs['remote_token']:
+            self.remote_token = kwargs['remote_token']
+
     def close(self):
+        self.reconnect = False
         self.disconnect()
 
         if self.sock:
@@ -224,82 +673,526 @@ class Peer:
 
         self.state_lock.release()
 
+        if self.outbox:
+            self.outbox.close()
+            self.outbox = None
+
         if self.conn:
             self.conn.close()
             self.conn = None
 
-        return state in ('connected', 'connecting')
+        return state in ('connected', 'connecting', 'reconnecting')
+
+    def hang_up(self):
+        self.reconnect = False
+
+        # Peers that answer pings also know not to reconnect after a bye.
+        if self.is_connected() and self.peer_heartbeat:
+            self.send_bye()
+
+        return self.disconnect()
+
+    def send_bye(self):
+        outbox = self.outbox
+
+        try:
+            outbox.send(self.encode_message('bye', {}))
+        except Exception:
+            return
+
+        outbox.wait_sent(const.BYE_TIMEOUT)
 
     def delete(self):
-        self.daemon.db_write(f'DELETE FROM peers WHERE alias="{self.alias}"')
+        self.daemon.db_write('DELETE FROM peers WHERE alias = ?', (self.alias,))
         self.close()
 
-    def recv(self, bufsize=4096):
+    def recv(self, bufsize=const.DEFAULT_RECV_BUFSIZE):
         return self.conn.recv(bufsize)
 
-    def send(self, data):
-        return self.conn.send(data)
+    def recv_into(self, buffer, nbytes=0):
+        return self.conn.recv_into(buffer, nbytes)
 
-    def sendmessage(self, msg_type, msg_data):
-        payload = json.dumps({'type': msg_type, 'data': msg_data}).encode()
-        header = struct.pack('!I', len(payload))
+    def tls_name(self):
+        if not self.remote_token:
+            return None
 
-        return self.send(header + payload)
+        return demux.tls_name(self.remote_token)
 
-    def sendfile(self, file):
-        return self.conn.sendfile(file)
+    def tls_path(self):
+        conn = self.conn
+        return conn.tls_path if conn else ''
 
-    def send_text(self, content):
-        sent_at = time.time()
+    def tls_handshake(self):
+        conn = self.conn
 
-        self.daemon.db_write(
-            f'INSERT INTO texts VALUES ("{self.alias}", "{content}", {sent_at}, {False})'
+        if not conn or conn.handshake_time is None:
+            return None, False
+
+        return conn.handshake_time, conn.resumed
+
+    def connect_time(self):
+        conn = self.conn
+        return conn.connect_time if conn else None
+
+    def send(self, data, bounded=False):
+        outbox = self.outbox
+
+        if not outbox:
+            raise Exception(f'Peer {self.alias} isn\'t connected')
+
+        return outbox.send(data, bounded)
+
+    def add_stream(self, stream):
+        outbox = self.outbox
+
+        if not outbox:
+            raise Exception(f'Peer {self.alias} isn\'t connected')
+
+        return outbox.add_stream(stream)
+
+    def sendmessage(self, msg_type, msg_data, bounded=False):
+        return self.send(self.encode_message(msg_type, msg_data), bounded)
+
+    def encode_message(self, msg_type, msg_data):
+        return wire.encode(
+            msg_type,
+            msg_data,
+            binary=self.peer_version >= wire.VERSION,
+            compress='zlib' in self.peer_codecs
         )
 
+    def reset_hello(self):
+        self.peer_codecs = []
+        self.peer_version = 1
+        self.peer_heartbeat = False
+
+    def send_hello(self):
+        self.sendmessage('hello', {
+            'codecs': codec.available(),
+            'version': wire.VERSION,
+            'heartbeat': True
+        })
+
+    def send_text(self, content):
+        sent_at = time.time()
+
         self.sendmessage('text', {
             'content': content,
             'sent_at': sent_at
+        }, bounded=True)
+
+        self.daemon.db_write(
+            'INSERT INTO texts VALUES (?, ?, ?, ?)',
+            (self.alias, content, sent_at, False)
+        )
+
+    def read_history(self, table, time_key, since, before, limit, after=None):
+        remaining = limit
+        last = after
+
+        while remaining is None or remaining > 0:
+            sql = f'SELECT rowid, {time_key}, * FROM {table} WHERE peer = ?'
+            params = [self.alias]
+
+            if since is not None:
+                sql += f' AND {time_key} >= ?'
+                params.append(since)
+
+            if before is not None:
+                sql += f' AND {time_key} < ?'
+                params.append(before)
+
+            if last:
+                sql += f' AND ({time_key}, rowid) > (?, ?)'
+                params.extend(last)
+
+            page_rows = const.HISTORY_PAGE_ROWS
+
+            if remaining is not None:
+                page_rows = min(page_rows, remaining)
+                remaining -= page_rows
+
+            sql += f' ORDER BY {time_key}, rowid LIMIT ?'
+            params.append(page_rows)
+
+            rows = self.daemon.db_read(sql, params).fetchall()
+
+            for row in rows:
+                yield f'{row[1]!r}:{row[0]}', row[2:]
+
+            if len(rows) < page_rows:
+                break
+
+            last = (rows[-1][1], rows[-1][0])
+
+    def read_texts(self, since=None, before=None, limit=None, after=None):
+        for cursor, row in self.read_history('texts', 'sent_at', since, before, limit, after):
+            yield {
+                'peer': row[0],
+                'content': row[1],
+                'sent_at': row[2],
+                'from_peer': bool(row[3]),
+                'cursor': cursor
+            }
+
+    def share_file(self, filepath, stat, use_delta=False, stripes=0):
+        if use_delta and stripes:
+            raise Exception('Delta transfers can\'t be striped')
+
+        if not 0 <= stripes <= const.MAX_STRIPES:
+            raise Exception(f'Number of stripes must be between 0 and {const.MAX_STRIPES}')
+
+        msg_data = self.file_header(filepath, stat.st_size)
+        chunks = self.daemon.cached_chunks(filepath, stat) if use_delta else None
+
+        self.record_transfer(filepath, msg_data)
+
+        return self.daemon.transfers.submit(self, filepath, msg_data, use_delta, chunks, stripes)
+
+    def file_header(self, filepath, filesize):
+        return {
+            'id': transfer.new_transfer_id(),
+            'filename': os.path.basename(filepath),
+            'filesize': filesize,
+            'shared_at': time.time(),
+            'offset': 0
+        }
+
+    def start_transfer(self, job):
+        threading.Thread(target=self.run_transfer, args=(job,), daemon=True).start()
+
+    def run_transfer(self, job):
+        try:
+            job.start()
+            self.prepare_delta(job)
+            self.send_file(job)
+            job.finish('sent')
+        except Exception as e:
+            job.finish('failed', e)
+            print(e)
+        finally:
+            self.daemon.transfers.finish(job)
+
+    def send_file(self, job):
+        if job.stripes and job.chunks is None and job.filesize - job.sent >= const.STRIPE_MIN_SIZE:
+            stripes = self.open_stripes(job)
+
+            try:
+                if stripes:
+                    return self.send_striped(job, stripes)
+            finally:
+                for stripe in stripes:
+                    stripe.close()
+
+            print(f'Peer {self.alias}: no stripes opened for transfer {job.id}, sending on one connection')
+
+        with open(job.filepath, 'rb') as file:
+            self.sendmessage('file', self.file_message(job))
+            self.send_chunk_list(job)
+
+            segments = self.delta_segments(job)
+            stream = outbox.FileStream(
+                job,
+                file,
+                self.encode_message,
+                segments,
+                codec.negotiate(self.peer_codecs)
+            )
+
+            if stream.segments:
+                self.add_stream(stream)
+                stream.wait()
+
+    def open_stripes(self, job):
+        self.sendmessage('stripe', {'id': job.id, 'count': job.stripes})
+
+        stripes = [conn.StripeConn(self, index) for index in range(1, job.stripes + 1)]
+        threads = [threading.Thread(target=self.open_stripe, args=(stripe,)) for stripe in stripes]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        return [stripe for stripe in stripes if stripe.sock]
+
+    def open_stripe(self, stripe):
+        try:
+            stripe.connect()
+        except Exception as e:
+            print(e)
+
+    def send_striped(self, job, stripes):
+        ranges = transfer.split_ranges(job.sent, job.filesize, len(stripes))
+        lanes = [(stripe, start, end) for stripe, (start, end) in zip(stripes, ranges)]
+        errors = []
+
+        self.sendmessage('file', dict(
+            job.msg_data,
+            stripes=[[stripe.index, start, end] for stripe, start, end in lanes]
+        ))
+
+        threads = [
+            threading.Thread(target=self.send_lane, args=(job, stripe, start, end, errors))
+            for stripe, start, end in lanes
+        ]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0]
+
+    def send_lane(self, job, stripe, start, end, errors):
+        try:
+            with open(job.filepath, 'rb') as file:
+                offset = start
+
+                while offset < end:
+                    size = min(const.FILE_CHUNK_SIZE, end - offset)
+                    header = self.encode_message('chunk', {'id': job.id, 'offset': offset, 'size': size})
+
+                    stripe.sendmsg([header], more=True)
+                    stripe.sendfile(file, offset, size)
+
+                    offset += size
+                    job.add_progress(size)
+
+        except Exception as e:
+            errors.append(e)
+
+    def file_message(self, job):
+        if job.chunks is None:
+            return job.msg_data
+
+        return dict(job.msg_data, delta=True)
+
+    def send_chunk_list(self, job):
+        if job.chunks is None:
+            return
+
+        for page, last in delta.pages(job.chunks):
+            self.sendmessage('chunks', {'id': job.id, 'chunks': page, 'last': last})
+
+    def prepare_delta(self, job):
+        if job.use_delta and job.chunks is None:
+            job.chunks = self.index_file(job.filepath)
+
+    def delta_segments(self, job):
+        if job.chunks is None:
+            return None
+
+        have = job.wait_have()
+
+        if have is None:
+            print(f'Peer {self.alias}: no delta answer for transfer {job.id}, sending whole file')
+            return None
+
+        return delta.plan_segments(job.chunks, have, job.sent)
+
+    def index_file(self, filepath):
+        stat = os.stat(filepath)
+        chunks = delta.chunk_file(filepath)
+
+        self.daemon.recvd.put({
+            'type': 'index',
+            'peer': self.alias,
+            'data': {
+                'path': filepath,
+                'size': stat.st_size,
+                'mtime': stat.st_mtime_ns,
+                'chunks': chunks
+            }
         })
 
-    def read_texts(self):
-        sql = f'SELECT * FROM texts WHERE peer="{self.alias}" ORDER BY sent_at'
-        rows = self.daemon.db_read(sql).fetchall()
+        return chunks
+
+    def answer_delta(self, transfer_id, chunks, sources):
+        known = {}
+
+        for path, cached in sources:
+            try:
+                index = self.index_file(path) if cached is None else cached
+            except OSError as e:
+                print(e)
+                continue
+
+            for offset, size, digest in delta.chunk_offsets(index):
+                known.setdefault(digest, (path, offset, size))
+
+        have = []
+        copies = {}
+
+        for i, (offset, size, digest) in enumerate(delta.chunk_offsets(chunks)):
+            source = known.get(digest)
+
+            if source and source[2] == size:
+                have.append(i)
+                copies[offset] = source + (digest,)
+
+        incoming = self.incoming.get(transfer_id)
+
+        if incoming:
+            incoming.copies = copies
+        else:
+            have = []
+
+        try:
+            for page, last in delta.pages(have):
+                self.sendmessage('have', {'id': transfer_id, 'chunks': page, 'last': last})
+        except Exception as e:
+            print(e)
+
+    def record_transfer(self, filepath, msg_data):
+        self.daemon.db_write('INSERT INTO transfers VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (
+            msg_data['id'],
+            self.alias,
+            msg_data['filename'],
+            filepath,
+            msg_data['filesize'],
+            msg_data['shared_at'],
+            msg_data['offset'],
+            False
+        ))
+
+    def send_resume(self):
+        sql = 'SELECT id, filesize, offset FROM transfers WHERE peer = ? AND from_peer = ?'
+        rows = self.daemon.db_read(sql, (self.alias, True)).fetchall()
+        transfers = {}
+
+        for transfer_id, filesize, offset in rows:
+            if offset < filesize:
+                offset = transfer.durable_offset(self.daemon.files_path, self.alias, transfer_id, offset)
 
-        return [{
-            'peer': row[0],
-            'content': row[1],
-            'sent_at': row[2],
-            'from_peer': bool(row[3])
-        } for row in rows]
+            transfers[transfer_id] = offset
 
-    def share_file(self, filepath):
-        filename = os.path.basename(filepath)
-        filesize = os.path.getsize(filepath)
-        shared_at = time.time()
+        self.sendmessage('resume', {'transfers': transfers})
 
-        self.sendmessage('file', {
+        self.daemon.db_write(
+            'DELETE FROM transfers WHERE peer = ? AND from_peer = ? AND offset >= filesize',
+            (self.alias, True)
+        )
+
+    def resume_transfers(self, offsets):
+        for transfer_id in offsets:
+            transfer.check_transfer_id(transfer_id)
+
+        sql = '''SELECT id, filename, filepath, filesize, shared_at
+            FROM transfers WHERE peer = ? AND from_peer = ?'''
+
+        rows = self.daemon.db_read(sql, (self.alias, False)).fetchall()
+
+        for transfer_id, filename, filepath, filesize, shared_at in rows:
+            if self.daemon.transfers.is_active(transfer_id):
+                continue
+
+            offset = offsets.get(transfer_id, 0)
+
+            if offset >= filesize:
+                self.complete_transfer(transfer_id)
+                continue
+
+            try:
+                if os.path.getsize(filepath) != filesize:
+                    raise Exception(f'File changed since transfer started: {filepath}')
+
+                self.daemon.transfers.submit(self, filepath, {
+                    'id': transfer_id,
+                    'filename': filename,
+                    'filesize': filesize,
+                    'shared_at': shared_at,
+                    'offset': offset
+                })
+
+            except Exception as e:
+                print(e)
+
+                self.daemon.db_write(
+                    'DELETE FROM transfers WHERE id = ? AND from_peer = ?',
+                    (transfer_id, False)
+                )
+
+    def complete_transfer(self, transfer_id):
+        sql = '''SELECT filename, filepath, filesize, shared_at
+            FROM transfers WHERE id = ? AND peer = ? AND from_peer = ?'''
+
+        row = self.daemon.db_read(sql, (transfer_id, self.alias, False)).fetchone()
+
+        if not row:
+            return
+
+        filename, filepath, filesize, shared_at = row
+
+        self.record_shared_file(filepath, {
             'filename': filename,
             'filesize': filesize,
             'shared_at': shared_at
         })
 
-        with open(filepath, 'rb') as file:
-            self.sendfile(file)
+        self.daemon.db_write(
+            'DELETE FROM transfers WHERE id = ? AND from_peer = ?',
+            (transfer_id, False)
+        )
+
+        self.daemon.transfers.complete(transfer_id)
+
+    def cancel_transfer(self, transfer_id):
+        job = self.daemon.transfers.cancel(transfer_id)
+
+        sql = 'SELECT count(*) FROM transfers WHERE id = ? AND peer = ? AND from_peer = ?'
+        exists = self.daemon.db_read(sql, (transfer_id, self.alias, False)).fetchone()[0]
+
+        if not job and not exists:
+            raise Exception(f'Transfer {transfer_id} not found')
+
+        self.daemon.db_write(
+            'DELETE FROM transfers WHERE id = ? AND from_peer = ?',
+            (transfer_id, False)
+        )
 
-        sql = f'''INSERT INTO files VALUES
-            ("{self.alias}", "{filename}", "{filepath}", {filesize}, {shared_at}, {False})'''
+        if self.is_connected():
+            self.sendmessage('cancel', {'id': transfer_id})
 
-        self.daemon.db_write(sql)
+    def cancel_incoming(self, transfer_id):
+        transfer.check_transfer_id(transfer_id)
+        incoming = self.incoming.pop(transfer_id, None)
 
-    def list_files(self):
-        sql = f'SELECT * FROM files WHERE peer="{self.alias}" ORDER BY shared_at'
-        rows = self.daemon.db_read(sql).fetchall()
+        if incoming:
+            incoming.close()
+
+        if self.recvchunk and self.recvchunk['transfer'] is incoming:
+            self.recvchunk['transfer'] = None
+
+        try:
+            os.remove(os.path.join(transfer.partial_dir(self.daemon.files_path, self.alias), transfer_id))
+        except FileNotFoundError:
+            pass
+
+    def list_transfers(self):
+        return self.daemon.transfers.status(self)
+
+    def record_shared_file(self, filepath, msg_data):
+        filename = msg_data['filename']
+        filesize = msg_data['filesize']
+        shared_at = msg_data['shared_at']
+
+        self.daemon.db_write(
+            'INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)',
+            (self.alias, filename, filepath, filesize, shared_at, False)
+        )
 
-        return [{
-            'peer': row[0],
-            'filename': row[1],
-            'filepath': row[2],
-            'filesize': row[3],
-            'shared_at': row[4],
-            'from_peer': bool(row[5])
-        } for row in rows]
+    def list_files(self, since=None, before=None, limit=None, after=None):
+        for cursor, row in self.read_history('files', 'shared_at', since, before, limit, after):
+            yield {
+                'peer': row[0],
+                'filename': row[1],
+                'filepath': row[2],
+                'filesize': row[3],
+                'shared_at': row[4],
+                'from_peer': bool(row[5]),
+                'cursor': cursor
+            }
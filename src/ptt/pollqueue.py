@@ -1,23 +1,73 @@
-import queue
+import collections
+import os
 import socket
+import threading
 
-class PollQueue(queue.SimpleQueue):
+class PollQueue:
     def __init__(self):
-        super().__init__()
+        self.items = collections.deque()
+        self.lock = threading.Lock()
+        self.signalled = False
 
-        self.rsock, self.wsock = socket.socketpair()
+        if hasattr(os, 'eventfd'):
+            self.efd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+            self.rsock = self.wsock = None
+        else:
+            self.efd = None
+            self.rsock, self.wsock = socket.socketpair()
+            self.rsock.setblocking(False)
+            self.wsock.setblocking(False)
 
     def fileno(self):
+        if self.efd is not None:
+            return self.efd
+
         return self.rsock.fileno()
 
-    def put(self, *args, **kwargs):
-        super().put(*args, **kwargs)
-        self.wsock.send(b'!')
+    def signal(self):
+        try:
+            if self.efd is not None:
+                os.eventfd_write(self.efd, 1)
+            else:
+                self.wsock.send(b'!')
+        except BlockingIOError:
+            pass
+
+    def clear(self):
+        try:
+            if self.efd is not None:
+                os.eventfd_read(self.efd)
+            else:
+                while self.rsock.recv(4096):
+                    pass
+        except BlockingIOError:
+            pass
+
+    def put(self, item):
+        with self.lock:
+            self.items.append(item)
+
+            if not self.signalled:
+                self.signalled = True
+                self.signal()
+
+    def drain(self):
+        with self.lock:
+            items = self.items
+            self.items = collections.deque()
+
+            if self.signalled:
+                self.signalled = False
+                self.clear()
+
+        return items
 
-    def get(self, *args, **kwargs):
-        self.rsock.recv(1)
-        return super().get(*args, **kwargs)
+    def empty(self):
+        return not self.items
 
     def close(self):
-        self.rsock.close()
-        self.wsock.close()
+        if self.efd is not None:
+            os.close(self.efd)
+        else:
+            self.rsock.close()
+            self.wsock.close()
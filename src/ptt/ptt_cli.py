@@ -19,9 +19,21 @@ def run():
     subparsers.add_parser('connect')
     subparsers.add_parser('disconnect')
     subparsers.add_parser('send-text')
-    subparsers.add_parser('read-texts')
-    subparsers.add_parser('share-file')
-    subparsers.add_parser('list-files')
+    texts_parser = subparsers.add_parser('read-texts')
+    texts_parser.add_argument('--since', type=str)
+    texts_parser.add_argument('--before', type=str)
+    texts_parser.add_argument('--limit', type=str)
+    texts_parser.add_argument('--after', type=str)
+    share_parser = subparsers.add_parser('share-file')
+    share_parser.add_argument('-d', '--delta', default=False, action='store_true')
+    share_parser.add_argument('-s', '--stripes', default=0, type=int)
+    files_parser = subparsers.add_parser('list-files')
+    files_parser.add_argument('--since', type=str)
+    files_parser.add_argument('--before', type=str)
+    files_parser.add_argument('--limit', type=str)
+    files_parser.add_argument('--after', type=str)
+    subparsers.add_parser('transfers')
+    subparsers.add_parser('cancel-transfer')
 
     parser.add_argument('alias', type=str, help='alias of peer')
 
@@ -36,6 +48,31 @@ def run():
     args = vars(parser.parse_args())
     client = common.Client()
 
+    def history_range():
+        since = args.get('since')
+        before = args.get('before')
+        limit = args.get('limit')
+        after = args.get('after')
+
+        return (
+            common.parse_time(since) if since else None,
+            common.parse_time(before) if before else None,
+            common.parse_limit(limit) if limit else None,
+            common.parse_cursor(after) if after else None
+        )
+
+    def print_page(rows, format_row):
+        count = 0
+        cursor = None
+
+        for row in rows:
+            print(format_row(row))
+            count += 1
+            cursor = row['cursor']
+
+        if args.get('limit') and count == common.parse_limit(args['limit']):
+            print(f'More: --after {cursor}')
+
     def remove_peer():
         if cmd in ('add', 'add6'):
             alias = args['alias']
@@ -49,33 +86,37 @@ def run():
 
     try:
         if not cmd:
-            client.exit('usage: ptt {add,add6,edit,edit6,remove,show,connect,disconnect,send-text,read-texts,share-file,list-files} ...')
+            client.exit('usage: ptt {add,add6,edit,edit6,remove,show,connect,disconnect,send-text,read-texts,share-file,list-files,transfers,cancel-transfer} ...')
 
         common.ensure_daemon_running()
 
         if cmd == 'add':
             alias = args['alias']
-            public_ip4, _, local_port = client.init_peer(alias, new_port=True)
+            public_ip4, _, local_port, token = client.init_peer(alias, new_port=True)
 
-            print(f'Share with {alias}: public_ip4={public_ip4}, local_port={local_port}')
+            print(f'Share with {alias}: public_ip4={public_ip4}, local_port={local_port}, token={token}')
 
             remote_ip = common.prompt_remote_ip(alias, required=True)
             remote_port = common.prompt_remote_port(alias, required=True)
+            alt_ip = common.prompt_remote_ip(alias, is_ipv6=True, fallback=True)
+            remote_token = common.prompt_remote_token(alias)
 
-            client.edit_peer(alias, '', remote_ip, remote_port)
+            client.edit_peer(alias, '', remote_ip, remote_port, alt_ip, remote_token)
 
             print(f'Added peer: {alias}')
 
         elif cmd == 'add6':
             alias = args['alias']
-            _, public_ip6, local_port = client.init_peer(alias, is_ipv6=True, new_port=True)
+            _, public_ip6, local_port, token = client.init_peer(alias, is_ipv6=True, new_port=True)
 
-            print(f'Share with {alias}: public_ip6={public_ip6}, local_port={local_port}')
+            print(f'Share with {alias}: public_ip6={public_ip6}, local_port={local_port}, token={token}')
 
             remote_ip = common.prompt_remote_ip(alias, is_ipv6=True, required=True)
             remote_port = common.prompt_remote_port(alias, required=True)
+            alt_ip = common.prompt_remote_ip(alias, is_ipv6=False, fallback=True)
+            remote_token = common.prompt_remote_token(alias)
 
-            client.edit_peer(alias, '', remote_ip, remote_port)
+            client.edit_peer(alias, '', remote_ip, remote_port, alt_ip, remote_token)
 
             print(f'Added peer: {alias}')
 
@@ -86,17 +127,19 @@ def run():
 
             new_port = input('Change local port? [y/N]: ').strip().lower() == 'y'
 
-            public_ip4, _, local_port = client.init_peer(
+            public_ip4, _, local_port, token = client.init_peer(
                 alias, new_port=new_port, should_exist=True
             )
 
-            print(f'Share with {alias}: public_ip4={public_ip4}, local_port={local_port}')
+            print(f'Share with {alias}: public_ip4={public_ip4}, local_port={local_port}, token={token}')
 
             new_alias = input('New alias: ').strip()
             remote_ip = common.prompt_remote_ip(alias)
             remote_port = common.prompt_remote_port(alias)
+            alt_ip = common.prompt_remote_ip(alias, is_ipv6=True, clearable=True)
+            remote_token = common.prompt_remote_token(alias)
 
-            client.edit_peer(alias, new_alias, remote_ip, remote_port)
+            client.edit_peer(alias, new_alias, remote_ip, remote_port, alt_ip, remote_token)
 
             print(f'Edited peer: {new_alias or alias}')
 
@@ -107,17 +150,19 @@ def run():
 
             new_port = input('Change local port? [y/N]: ').strip().lower() == 'y'
 
-            _, public_ip6, local_port = client.init_peer(
+            _, public_ip6, local_port, token = client.init_peer(
                 alias, is_ipv6=True, new_port=new_port, should_exist=True
             )
 
-            print(f'Share with {alias}: public_ip6={public_ip6}, local_port={local_port}')
+            print(f'Share with {alias}: public_ip6={public_ip6}, local_port={local_port}, token={token}')
 
             new_alias = input('New alias: ').strip()
             remote_ip = common.prompt_remote_ip(alias, is_ipv6=True)
             remote_port = common.prompt_remote_port(alias)
+            alt_ip = common.prompt_remote_ip(alias, is_ipv6=False, clearable=True)
+            remote_token = common.prompt_remote_token(alias)
 
-            client.edit_peer(alias, new_alias, remote_ip, remote_port)
+            client.edit_peer(alias, new_alias, remote_ip, remote_port, alt_ip, remote_token)
 
             print(f'Edited peer: {new_alias or alias}')
 
@@ -129,9 +174,16 @@ def run():
 
         elif cmd == 'show':
             alias = args['alias']
-            _, _, local_port, remote_ip, remote_port, state = client.show_peer(alias)
+            _, _, local_port, remote_ip, remote_port, tls, (connect_time, handshake_time, resumed), state, (attempts, rtt, uptime) = client.show_peer(alias)
+            connect = '' if connect_time is None else f'{connect_time:.2f}s'
+            handshake = '' if handshake_time is None else f'{handshake_time * 1000:.1f}ms'
+            rtt = '' if rtt is None else f'{rtt * 1000:.1f}ms'
+            uptime = '' if uptime is None else common.format_duration(uptime)
 
-            print(f'Peer {alias}: local_port={local_port}, remote_ip={remote_ip}, remote_port={remote_port}, state="{state}"')
+            if resumed:
+                handshake += ', resumed'
+
+            print(f'Peer {alias}: local_port={local_port}, remote_ip={remote_ip}, remote_port={remote_port}, tls="{tls}", connect="{connect}", handshake="{handshake}", rtt="{rtt}", uptime="{uptime}", reconnects={attempts}, state="{state}"')
 
         elif cmd == 'connect':
             alias = args['alias']
@@ -155,7 +207,7 @@ def run():
 
         elif cmd == 'read-texts':
             alias = args['alias']
-            texts = client.read_texts(alias)
+            texts = client.read_texts(alias, *history_range())
 
             def format_text(text):
                 timestamp = round(text['sent_at'])
@@ -170,7 +222,7 @@ def run():
 
                 return preface + text['content']
 
-            print('\n'.join([format_text(text) for text in texts]))
+            print_page(texts, format_text)
 
         elif cmd == 'share-file':
             alias = args['alias']
@@ -187,13 +239,13 @@ def run():
             if not os.path.isfile(filepath):
                 raise Exception(f'No file exists: {filepath}')
 
-            client.share_file(alias, filepath)
+            job_id = client.share_file(alias, filepath, args['delta'], args['stripes'])
 
-            print(f'Shared file with {alias}')
+            print(f'Sharing file with {alias} (transfer {job_id})')
 
         elif cmd == 'list-files':
             alias = args['alias']
-            files = client.list_files(alias)
+            files = client.list_files(alias, *history_range())
 
             def format_file(file):
                 timestamp = round(file['shared_at'])
@@ -211,7 +263,42 @@ def run():
 
                 return preface + f'{filepath} ({fmtsize})'
 
-            print('\n'.join([format_file(file) for file in files]))
+            print_page(files, format_file)
+
+        elif cmd == 'transfers':
+            alias = args['alias']
+            transfers = client.transfer_status(alias)
+
+            def format_transfer(transfer):
+                filesize = transfer['filesize']
+                sent = transfer['sent']
+                percent = round(100 * sent / filesize) if filesize else 100
+                fmtsent = common.format_filesize(sent)
+                fmtsize = common.format_filesize(filesize)
+                line = f'[{transfer["state"]}] {transfer["id"]} {transfer["filename"]}: {fmtsent}/{fmtsize} ({percent}%)'
+
+                if transfer['rate']:
+                    line += f', {common.format_filesize(transfer["rate"])}/s'
+
+                if transfer['eta'] is not None:
+                    line += f', ETA {common.format_duration(transfer["eta"])}'
+
+                if transfer['codec'] and transfer['ratio']:
+                    line += f', {transfer["codec"]} {transfer["ratio"]:.2f}x'
+
+                if transfer['error']:
+                    line += f', error: {transfer["error"]}'
+
+                return line
+
+            print('\n'.join([format_transfer(transfer) for transfer in transfers]))
+
+        elif cmd == 'cancel-transfer':
+            alias = args['alias']
+            job_id = common.prompt(f'Enter ID of transfer to cancel with {alias}: ')
+            client.cancel_transfer(alias, job_id)
+
+            print(f'Cancelled transfer {job_id} with {alias}')
 
     except Exception as e:
         remove_peer()
@@ -2,7 +2,7 @@ import argparse
 import signal
 import sys
 
-from ptt import common
+from ptt import common, const
 
 def run():
     parser = argparse.ArgumentParser(prog='pttd')
@@ -10,12 +10,30 @@ def run():
 
     start_parser = subparsers.add_parser('start')
     start_parser.add_argument('-c', '--connect', default=False, action=argparse.BooleanOptionalAction)
+    start_parser.add_argument('-e', '--engine', default='thread', choices=('thread', 'asyncio'))
+    start_parser.add_argument('--fast-recv', default=False, action=argparse.BooleanOptionalAction)
+    start_parser.add_argument('--recv-bufsize', type=int, default=const.DEFAULT_RECV_BUFSIZE)
+    start_parser.add_argument('--durability', default=const.DEFAULT_DURABILITY, choices=('full', 'normal', 'off'))
+    start_parser.add_argument('--ident4', default=const.DEFAULT_IDENT4_ENDPOINT)
+    start_parser.add_argument('--ident6', default=const.DEFAULT_IDENT6_ENDPOINT)
+    start_parser.add_argument('--socket-activation', default=False, action=argparse.BooleanOptionalAction)
+    start_parser.add_argument('--shared-port', type=int, default=0)
+    start_parser.add_argument('--ping-timeout', type=float, default=const.DEFAULT_PING_TIMEOUT)
 
     subparsers.add_parser('status')
     subparsers.add_parser('stop')
 
     restart_parser = subparsers.add_parser('restart')
     restart_parser.add_argument('-c', '--connect', default=False, action=argparse.BooleanOptionalAction)
+    restart_parser.add_argument('-e', '--engine', default='thread', choices=('thread', 'asyncio'))
+    restart_parser.add_argument('--fast-recv', default=False, action=argparse.BooleanOptionalAction)
+    restart_parser.add_argument('--recv-bufsize', type=int, default=const.DEFAULT_RECV_BUFSIZE)
+    restart_parser.add_argument('--durability', default=const.DEFAULT_DURABILITY, choices=('full', 'normal', 'off'))
+    restart_parser.add_argument('--ident4', default=const.DEFAULT_IDENT4_ENDPOINT)
+    restart_parser.add_argument('--ident6', default=const.DEFAULT_IDENT6_ENDPOINT)
+    restart_parser.add_argument('--socket-activation', default=False, action=argparse.BooleanOptionalAction)
+    restart_parser.add_argument('--shared-port', type=int, default=0)
+    restart_parser.add_argument('--ping-timeout', type=float, default=const.DEFAULT_PING_TIMEOUT)
 
     subparsers.add_parser('clean')
 
@@ -32,7 +50,6 @@ def run():
     if cmd == 'clean':
         common.kill_daemon(signal.SIGTERM)
         common.remove_pidfile()
-        common.remove_client_sock()
         common.remove_server_sock()
 
         return
@@ -53,7 +70,18 @@ def run():
             if running:
                 raise Exception('Daemon already running')
 
-            common.start_daemon(args['connect'])
+            common.start_daemon(
+                args['connect'],
+                args['engine'],
+                args['fast_recv'],
+                args['recv_bufsize'],
+                args['durability'],
+                args['ident4'],
+                args['ident6'],
+                args['socket_activation'],
+                args['shared_port'],
+                args['ping_timeout']
+            )
 
             print('Started daemon')
 
@@ -68,7 +96,18 @@ def run():
             common.ensure_daemon_running()
             client.stop_daemon()
             common.remove_server_sock()
-            common.start_daemon(args['connect'])
+            common.start_daemon(
+                args['connect'],
+                args['engine'],
+                args['fast_recv'],
+                args['recv_bufsize'],
+                args['durability'],
+                args['ident4'],
+                args['ident6'],
+                args['socket_activation'],
+                args['shared_port'],
+                args['ping_timeout']
+            )
 
             print('Restarted daemon')
 
@@ -0,0 +1,156 @@
+import collections
+import threading
+import time
+
+from ptt import const
+
+class PeerRecord:
+    __slots__ = (
+        'alias', 'local_port', 'remote_ip', 'remote_port', 'alt_ip', 'token', 'remote_token', 'last_seen'
+    )
+
+    def __init__(
+            self, alias, local_port=0, remote_ip=None, remote_port=0, alt_ip='',
+            token='', remote_token='', last_seen=None
+    ):
+        self.alias = alias
+        self.local_port = local_port
+        self.remote_ip = remote_ip
+        self.remote_port = remote_port
+        self.alt_ip = alt_ip
+        self.token = token
+        self.remote_token = remote_token
+        self.last_seen = last_seen
+
+    def args(self):
+        return (
+            self.alias, self.local_port, self.remote_ip, self.remote_port, self.alt_ip,
+            self.token, self.remote_token
+        )
+
+class PeerRegistry:
+    def __init__(self, create_peer):
+        self.create_peer = create_peer
+        self.records = {}
+        self.peers = {}
+        # The demultiplexer looks up peers from its own threads.
+        self.lock = threading.Lock()
+
+    def load(self, rows):
+        with self.lock:
+            for row in rows:
+                record = PeerRecord(*row)
+                self.records[record.alias] = record
+
+    def __contains__(self, alias):
+        return alias in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, alias):
+        with self.lock:
+            peer = self.peers.get(alias)
+
+            if peer is None:
+                peer = self.create_peer(*self.records[alias].args())
+                self.peers[alias] = peer
+
+            return peer
+
+    def add(self, alias, peer):
+        with self.lock:
+            self.records[alias] = PeerRecord(alias)
+            self.peers[alias] = peer
+
+    def rename(self, alias, new_alias):
+        with self.lock:
+            record = self.records.pop(alias)
+            record.alias = new_alias
+            self.records[new_alias] = record
+
+            if alias in self.peers:
+                self.peers[new_alias] = self.peers.pop(alias)
+
+    def remove(self, alias):
+        with self.lock:
+            del self.records[alias]
+            self.peers.pop(alias, None)
+
+    def touch(self, alias, seen_at):
+        if alias in self.records:
+            self.records[alias].last_seen = seen_at
+
+    def local_ports(self):
+        with self.lock:
+            ports = {peer.local_port for peer in self.peers.values()}
+            ports.update(record.local_port for alias, record in self.records.items() if alias not in self.peers)
+
+        return ports
+
+    def loaded(self):
+        with self.lock:
+            return list(self.peers.values())
+
+    def by_activity(self):
+        records = sorted(self.records.values(), key=lambda record: record.last_seen or 0, reverse=True)
+
+        return [record.alias for record in records]
+
+class ConnectScheduler:
+    def __init__(
+            self,
+            registry,
+            start_peer,
+            limit=const.MAX_AUTO_CONNECTS,
+            attempt_timeout=const.AUTO_CONNECT_TIMEOUT
+    ):
+        self.registry = registry
+        self.start_peer = start_peer
+        self.limit = limit
+        self.attempt_timeout = attempt_timeout
+        self.pending = collections.deque()
+        self.active = {}
+
+    def schedule(self, aliases):
+        self.pending.extend(aliases)
+
+    def timeout(self):
+        if not self.active:
+            return None
+
+        return const.AUTO_CONNECT_POLL_INTERVAL
+
+    def poll(self):
+        now = time.monotonic()
+
+        for peer, deadline in list(self.active.items()):
+            if not peer.is_connecting():
+                del self.active[peer]
+
+            elif deadline <= now and self.pending:
+                # Others are waiting for a slot, so this peer goes to the back of the line.
+                peer.disconnect()
+                del self.active[peer]
+                self.pending.append(peer.alias)
+
+        while self.pending and len(self.active) < self.limit:
+            alias = self.pending.popleft()
+
+            if alias not in self.registry:
+                continue
+
+            peer = self.registry.get(alias)
+
+            if peer.is_connected() or peer.is_connecting() or peer.is_reconnecting():
+                continue
+
+            print('connecting ' + alias)
+
+            try:
+                self.start_peer(peer)
+            except Exception as e:
+                print(e)
+                continue
+
+            self.active[peer] = now + self.attempt_timeout
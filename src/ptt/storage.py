@@ -0,0 +1,64 @@
+import sqlite3
+import time
+
+from ptt import const
+
+SYNCHRONOUS = {
+    'full': 'FULL',
+    'normal': 'NORMAL',
+    'off': 'OFF'
+}
+
+class Storage:
+    def __init__(
+            self,
+            db_path,
+            *,
+            durability=const.DEFAULT_DURABILITY,
+            batch_size=const.DB_BATCH_SIZE,
+            batch_interval=const.DB_BATCH_INTERVAL
+    ):
+        if durability not in SYNCHRONOUS:
+            raise Exception(f'Unknown durability "{durability}"')
+
+        self.durability = durability
+        self.batch_size = 1 if durability == 'full' else batch_size
+        self.batch_interval = 0 if durability == 'full' else batch_interval
+        self.pending = 0
+        self.first_write_at = None
+
+        self.conn = sqlite3.connect(db_path, cached_statements=const.DB_CACHED_STATEMENTS)
+        self.cursor = self.conn.cursor()
+
+        self.cursor.execute('PRAGMA journal_mode=WAL')
+        self.cursor.execute(f'PRAGMA synchronous={SYNCHRONOUS[durability]}')
+
+    def read(self, sql, params=()):
+        return self.cursor.execute(sql, params)
+
+    def write(self, sql, params=()):
+        self.cursor.execute(sql, params)
+
+        if not self.pending:
+            self.first_write_at = time.monotonic()
+
+        self.pending += 1
+
+    def timeout(self):
+        if not self.pending:
+            return None
+
+        return max(0, self.first_write_at + self.batch_interval - time.monotonic())
+
+    def flush(self, force=False):
+        if not self.pending:
+            return
+
+        if force or self.pending >= self.batch_size or not self.timeout():
+            self.conn.commit()
+            self.pending = 0
+            self.first_write_at = None
+
+    def close(self):
+        self.flush(force=True)
+        self.conn.close()
@@ -0,0 +1,458 @@
+import collections
+import os
+import re
+import threading
+import time
+import uuid
+
+from ptt import const, delta
+
+TRANSFER_ID_PATTERN = re.compile('[0-9a-f]{32}')
+
+def new_transfer_id():
+    return uuid.uuid4().hex
+
+def is_transfer_id(transfer_id):
+    return isinstance(transfer_id, str) and TRANSFER_ID_PATTERN.fullmatch(transfer_id) is not None
+
+def check_transfer_id(transfer_id):
+    if not is_transfer_id(transfer_id):
+        raise Exception(f'Invalid transfer id: {transfer_id!r}')
+
+def partial_dir(files_path, alias):
+    return os.path.join(files_path, alias, '.partial')
+
+def received_path(peer_files_path, filename):
+    name = os.path.basename(filename) if isinstance(filename, str) else ''
+
+    if name in ('', '.', '..', '.partial'):
+        raise Exception(f'Invalid filename: {filename!r}')
+
+    filepath = os.path.join(peer_files_path, name)
+    root = os.path.realpath(peer_files_path)
+
+    if os.path.commonpath([root, os.path.realpath(filepath)]) != root:
+        raise Exception(f'Invalid filename: {filename!r}')
+
+    return name, filepath
+
+def durable_offset(files_path, alias, transfer_id, offset):
+    if not is_transfer_id(transfer_id):
+        return 0
+
+    try:
+        return min(offset, os.path.getsize(os.path.join(partial_dir(files_path, alias), transfer_id)))
+    except FileNotFoundError:
+        return 0
+
+def split_ranges(offset, filesize, count):
+    step = -(-(filesize - offset) // count)
+    step = -(-step // const.FILE_CHUNK_SIZE) * const.FILE_CHUNK_SIZE
+
+    return [(start, min(start + step, filesize)) for start in range(offset, filesize, step)]
+
+class IncomingTransfer:
+    def __init__(self, files_path, alias, msg):
+        msg_data = msg['data']
+
+        self.id = msg_data['id']
+        self.msg = msg
+        self.filesize = msg_data['filesize']
+        self.offset = msg_data['offset']
+        self.durable = self.offset
+        self.syncing = False
+        self.copies = {}
+        self.chunks = [] if msg_data.get('delta') else None
+
+        peer_files_path = os.path.join(files_path, alias)
+        partial_path = partial_dir(files_path, alias)
+
+        os.makedirs(partial_path, exist_ok=True)
+
+        msg_data['filename'], msg_data['filepath'] = received_path(peer_files_path, msg_data['filename'])
+        self.partial_path = os.path.join(partial_path, self.id)
+
+        self.open_partial()
+
+    def open_partial(self):
+        self.file = open(self.partial_path, 'ab')
+
+        if self.file.tell() < self.offset:
+            self.file.close()
+            raise Exception(f'Transfer {self.id}: partial file is shorter than offset {self.offset}')
+
+        self.file.truncate(self.offset)
+
+    def is_complete(self):
+        return self.offset >= self.filesize
+
+    def write(self, data):
+        self.file.write(data)
+        self.offset += len(data)
+
+    def view(self, nbytes):
+        return None
+
+    def read_copy(self, offset, size):
+        source = self.copies.get(offset)
+
+        if not source or source[2] != size:
+            raise Exception(f'Transfer {self.id}: no local copy of chunk at offset {offset}')
+
+        path, src_offset, _, digest = source
+
+        with open(path, 'rb') as file:
+            file.seek(src_offset)
+            data = file.read(size)
+
+        if delta.chunk_hash(data) != digest:
+            raise Exception(f'Transfer {self.id}: local copy of chunk at offset {offset} changed')
+
+        return data
+
+    def should_checkpoint(self):
+        return self.offset - self.durable >= const.TRANSFER_CHECKPOINT_SIZE
+
+    def checkpoint(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.durable = self.offset
+
+    def flush(self):
+        self.file.flush()
+
+        return os.dup(self.file.fileno())
+
+    def finish(self):
+        self.file.close()
+        os.replace(self.partial_path, self.msg['data']['filepath'])
+
+    def close(self):
+        if not self.file.closed:
+            self.checkpoint()
+            self.file.close()
+
+class DirectTransfer(IncomingTransfer):
+    def __init__(self, files_path, alias, msg):
+        self.fd = None
+        self.buffer = None
+
+        super().__init__(files_path, alias, msg)
+
+    def open_partial(self):
+        self.fd = os.open(self.partial_path, os.O_RDWR | os.O_CREAT, 0o644)
+
+        try:
+            if os.fstat(self.fd).st_size < self.offset:
+                raise Exception(f'Transfer {self.id}: partial file is shorter than offset {self.offset}')
+
+            os.ftruncate(self.fd, self.filesize)
+
+            if self.filesize and hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(self.fd, self.offset, self.filesize - self.offset)
+
+        except Exception:
+            os.close(self.fd)
+            self.fd = None
+            raise
+
+    def pwrite(self, data, offset):
+        view = memoryview(data)
+
+        while view:
+            nbytes = os.pwrite(self.fd, view, offset)
+            view = view[nbytes:]
+            offset += nbytes
+
+    def write(self, data):
+        self.pwrite(data, self.offset)
+        self.offset += len(data)
+
+    def view(self, nbytes):
+        if self.buffer is None:
+            self.buffer = bytearray(const.FILE_CHUNK_SIZE)
+
+        return memoryview(self.buffer)[:nbytes]
+
+    def received(self, nbytes):
+        self.write(memoryview(self.buffer)[:nbytes])
+
+    def checkpoint(self):
+        os.fsync(self.fd)
+        self.durable = self.offset
+
+    def flush(self):
+        return os.dup(self.fd)
+
+    def release(self):
+        os.close(self.fd)
+        self.fd = None
+
+    def finish(self):
+        self.release()
+        os.replace(self.partial_path, self.msg['data']['filepath'])
+
+    def close(self):
+        if self.fd is not None:
+            self.checkpoint()
+            self.release()
+
+class StripedTransfer(DirectTransfer):
+    def __init__(self, files_path, alias, msg):
+        self.lock = threading.Lock()
+        self.finished = False
+        self.lanes = {index: [start, end] for index, start, end in msg['data'].pop('stripes')}
+
+        super().__init__(files_path, alias, msg)
+
+    def is_complete(self):
+        return all(start >= end for start, end in self.lanes.values())
+
+    def lane_complete(self, index):
+        start, end = self.lanes[index]
+
+        return start >= end
+
+    def write(self, data):
+        raise Exception(f'Transfer {self.id}: striped data must arrive on a stripe')
+
+    def view(self, nbytes):
+        return None
+
+    def write_at(self, index, offset, data):
+        lane = self.lanes[index]
+
+        if offset != lane[0] or offset + len(data) > lane[1]:
+            raise Exception(f'Transfer {self.id}: unexpected data at offset {offset} on stripe {index}')
+
+        with self.lock:
+            if self.fd is None:
+                raise Exception(f'Transfer {self.id} closed')
+
+            self.pwrite(data, offset)
+            lane[0] += len(data)
+            self.offset = self.contiguous_offset()
+
+    def contiguous_offset(self):
+        for start, end in sorted(self.lanes.values(), key=lambda lane: lane[1]):
+            if start < end:
+                return start
+
+        return self.filesize
+
+    def take_finish(self):
+        with self.lock:
+            if self.finished or not self.is_complete():
+                return False
+
+            self.finished = True
+
+            return True
+
+    def checkpoint(self):
+        with self.lock:
+            if self.fd is not None:
+                os.fsync(self.fd)
+                self.durable = self.offset
+
+    def release(self):
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+    def close(self):
+        self.checkpoint()
+        self.release()
+
+class TransferJob:
+    def __init__(self, peer, filepath, msg_data, use_delta=False, chunks=None, stripes=0):
+        self.id = msg_data['id']
+        self.peer = peer
+        self.filepath = filepath
+        self.msg_data = msg_data
+        self.filename = msg_data['filename']
+        self.filesize = msg_data['filesize']
+        self.sent = msg_data['offset']
+        self.start_offset = self.sent
+        self.started_at = None
+        self.finished_at = None
+        self.state = 'queued'
+        self.error = None
+        self.cancelled = threading.Event()
+        self.use_delta = use_delta
+        self.chunks = chunks
+        self.stripes = stripes
+        self.lock = threading.Lock()
+        self.codec = None
+        self.payload_bytes = 0
+        self.wire_bytes = 0
+        self.have = None
+        self.have_pages = []
+        self.have_ready = threading.Event()
+
+    def start(self):
+        self.started_at = time.time()
+        self.state = 'running'
+
+    def progress(self, sent):
+        self.sent = sent
+
+        if self.cancelled.is_set():
+            raise Exception(f'Transfer {self.id} cancelled')
+
+    def add_progress(self, nbytes):
+        with self.lock:
+            self.sent += nbytes
+
+        if self.cancelled.is_set():
+            raise Exception(f'Transfer {self.id} cancelled')
+
+    def record_payload(self, raw, wire):
+        self.payload_bytes += raw
+        self.wire_bytes += wire
+
+    def compression_ratio(self):
+        return self.payload_bytes / self.wire_bytes if self.wire_bytes else None
+
+    def add_have(self, have, last):
+        self.have_pages.extend(have)
+
+        if last:
+            self.have = self.have_pages
+            self.have_ready.set()
+
+    def wait_have(self):
+        self.have_ready.wait(const.DELTA_HAVE_TIMEOUT)
+        self.progress(self.sent)
+
+        return self.have
+
+    def finish(self, state, error=None):
+        if self.state in ('cancelled', 'done'):
+            return
+
+        self.finished_at = time.time()
+        self.state = state
+        self.error = error and str(error)
+
+    def cancel(self):
+        self.cancelled.set()
+        self.have_ready.set()
+        self.finish('cancelled')
+
+    def rate(self):
+        if not self.started_at:
+            return 0
+
+        elapsed = (self.finished_at or time.time()) - self.started_at
+
+        return (self.sent - self.start_offset) / elapsed if elapsed > 0 else 0
+
+    def eta(self):
+        rate = self.rate()
+
+        if self.state != 'running' or not rate:
+            return None
+
+        return (self.filesize - self.sent) / rate
+
+    def status(self):
+        return {
+            'id': self.id,
+            'peer': self.peer.alias,
+            'filename': self.filename,
+            'filesize': self.filesize,
+            'sent': self.sent,
+            'rate': self.rate(),
+            'eta': self.eta(),
+            'state': self.state,
+            'codec': self.codec,
+            'ratio': self.compression_ratio(),
+            'error': self.error
+        }
+
+class TransferScheduler:
+    def __init__(self):
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.queues = {}
+        self.running = {}
+
+    def submit(self, peer, filepath, msg_data, use_delta=False, chunks=None, stripes=0):
+        job = TransferJob(peer, filepath, msg_data, use_delta, chunks, stripes)
+
+        with self.lock:
+            self.prune()
+            self.jobs[job.id] = job
+            self.queues.setdefault(peer, collections.deque()).append(job)
+
+        self.schedule(peer)
+
+        return job
+
+    def prune(self):
+        expired = time.time() - const.TRANSFER_RETENTION
+
+        for transfer_id, job in list(self.jobs.items()):
+            if job.finished_at is not None and job.finished_at < expired:
+                del self.jobs[transfer_id]
+
+    def schedule(self, peer):
+        with self.lock:
+            queue = self.queues.get(peer)
+            running = self.running.setdefault(peer, set())
+
+            if len(running) >= const.MAX_STREAMS_PER_PEER or not queue:
+                return
+
+            job = queue.popleft()
+            running.add(job)
+
+        peer.start_transfer(job)
+
+    def finish(self, job):
+        with self.lock:
+            self.running.get(job.peer, set()).discard(job)
+
+        self.schedule(job.peer)
+
+    def is_active(self, transfer_id):
+        job = self.jobs.get(transfer_id)
+
+        return bool(job) and job.state in ('queued', 'running')
+
+    def have(self, transfer_id, have, last):
+        job = self.jobs.get(transfer_id)
+
+        if job:
+            job.add_have(have, last)
+
+    def complete(self, transfer_id):
+        job = self.jobs.get(transfer_id)
+
+        if job:
+            job.finish('done')
+
+    def cancel(self, transfer_id):
+        with self.lock:
+            job = self.jobs.get(transfer_id)
+
+            if not job:
+                return None
+
+            queue = self.queues.get(job.peer)
+
+            if queue and job in queue:
+                queue.remove(job)
+
+        job.cancel()
+
+        return job
+
+    def status(self, peer=None):
+        with self.lock:
+            self.prune()
+            jobs = list(self.jobs.values())
+
+        return [job.status() for job in jobs if peer is None or job.peer is peer]
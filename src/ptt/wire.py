@@ -0,0 +1,124 @@
+import json
+import struct
+
+from ptt import framing
+
+VERSION = 2
+
+TEXT = 1
+FILE = 2
+CHUNK = 3
+COPY = 4
+DONE = 5
+CANCEL = 6
+
+TEXT_LAYOUT = struct.Struct('!d')
+FILE_LAYOUT = struct.Struct('!16sQQd')
+CHUNK_LAYOUT = struct.Struct('!16sQIIB')
+COPY_LAYOUT = struct.Struct('!16sQI')
+ID_LAYOUT = struct.Struct('!16s')
+
+FILE_KEYS = {'id', 'filename', 'filesize', 'shared_at', 'offset'}
+CHUNK_CODECS = ('', 'zlib', 'lz4')
+
+def pack_id(transfer_id):
+    if len(transfer_id) != 32:
+        return None
+
+    try:
+        return bytes.fromhex(transfer_id)
+    except ValueError:
+        return None
+
+def encode_body(msg_type, msg_data):
+    if msg_type == 'text':
+        return TEXT, TEXT_LAYOUT.pack(msg_data['sent_at']) + msg_data['content'].encode()
+
+    if msg_type not in ('file', 'chunk', 'copy', 'done', 'cancel'):
+        return None, None
+
+    transfer_id = pack_id(msg_data['id'])
+
+    if transfer_id is None:
+        return None, None
+
+    if msg_type == 'file':
+        if msg_data.keys() != FILE_KEYS:
+            return None, None
+
+        return FILE, FILE_LAYOUT.pack(
+            transfer_id,
+            msg_data['filesize'],
+            msg_data['offset'],
+            msg_data['shared_at']
+        ) + msg_data['filename'].encode()
+
+    if msg_type == 'chunk':
+        return CHUNK, CHUNK_LAYOUT.pack(
+            transfer_id,
+            msg_data['offset'],
+            msg_data['size'],
+            msg_data.get('length', msg_data['size']),
+            CHUNK_CODECS.index(msg_data.get('codec', ''))
+        )
+
+    if msg_type == 'copy':
+        return COPY, COPY_LAYOUT.pack(transfer_id, msg_data['offset'], msg_data['size'])
+
+    return DONE if msg_type == 'done' else CANCEL, ID_LAYOUT.pack(transfer_id)
+
+def encode(msg_type, msg_data, binary=False, compress=False):
+    if binary:
+        kind, body = encode_body(msg_type, msg_data)
+
+        if kind is not None:
+            return framing.encode_binary_frame(kind, body, compress)
+
+    payload = json.dumps({'type': msg_type, 'data': msg_data}).encode()
+
+    return framing.encode_frame(payload, compress)
+
+def decode(kind, payload):
+    if kind == framing.JSON:
+        return json.loads(str(payload, 'utf8'))
+
+    if kind == TEXT:
+        sent_at, = TEXT_LAYOUT.unpack_from(payload)
+
+        return {'type': 'text', 'data': {
+            'content': str(payload[TEXT_LAYOUT.size:], 'utf8'),
+            'sent_at': sent_at
+        }}
+
+    if kind == FILE:
+        transfer_id, filesize, offset, shared_at = FILE_LAYOUT.unpack_from(payload)
+
+        return {'type': 'file', 'data': {
+            'id': transfer_id.hex(),
+            'filename': str(payload[FILE_LAYOUT.size:], 'utf8'),
+            'filesize': filesize,
+            'shared_at': shared_at,
+            'offset': offset
+        }}
+
+    if kind == CHUNK:
+        transfer_id, offset, size, length, codec_id = CHUNK_LAYOUT.unpack_from(payload)
+        msg_data = {'id': transfer_id.hex(), 'offset': offset, 'size': size}
+
+        if codec_id:
+            msg_data['length'] = length
+            msg_data['codec'] = CHUNK_CODECS[codec_id]
+
+        return {'type': 'chunk', 'data': msg_data}
+
+    if kind == COPY:
+        transfer_id, offset, size = COPY_LAYOUT.unpack_from(payload)
+
+        return {'type': 'copy', 'data': {'id': transfer_id.hex(), 'offset': offset, 'size': size}}
+
+    if kind in (DONE, CANCEL):
+        transfer_id, = ID_LAYOUT.unpack_from(payload)
+
+        return {'type': 'done' if kind == DONE else 'cancel', 'data': {'id': transfer_id.hex()}}
+
+    raise Exception(f'Unexpected frame type {kind}')